@@ -1,100 +1,324 @@
 import asyncio
 import logging
+import os
+import signal
 import sys
 import argparse
-import threading
+import json
+from contextlib import suppress
 from datetime import datetime
+from typing import Dict, List
 
-from flask import Flask, jsonify, send_file
-from backend.src.BoxMarker import BoxMarker
-from backend.src.DataMatrixDecoderMock import DataMatrixDecoderMock
-from backend.src.FileSaver import FileSaver
-from backend.src.DataMatrixDecoder import DataMatrixDecoder
-
-log = logging.getLogger('werkzeug')
-log.setLevel(logging.ERROR)
-app = Flask(__name__)
-box_marker: BoxMarker | None = None
-http_port: int = 8001
-
-
-async def run_marker(url: str, timeout: int, expected_num: int, max_failures: int, test: bool = False):
-    global box_marker
-    file_saver = FileSaver()
-    box_marker = BoxMarker(file_saver=file_saver, expected_bottles_number=expected_num,
-                           max_failed_attempts=max_failures)
-    file_saver.subscribe(box_marker)
-    if not test:
-        decoder = DataMatrixDecoder(url=url, max_count=expected_num, timeout=timeout,
-                                    callback=box_marker.process_detected_codes)
+from hypercorn.asyncio import serve
+from hypercorn.config import Config
+from quart import Quart, Response, abort, jsonify, request, send_file
+from backend.src.DatabaseManager import DatabaseManager
+from backend.src.DecodeExecutor import DECODE_EXECUTOR_KINDS, DecodeExecutor, create_decode_executor
+from backend.src.FrameBuffer import FrameBufferPolicy
+from backend.src.FramePreprocessor import IMREAD_MODES, FramePreprocessor
+from backend.src.FrameSource import FRAME_SOURCE_KINDS
+from backend.src.PackingLine import LineConfig, PackingLine, load_line_configs
+from backend.src.metrics import REGISTRY
+
+app = Quart(__name__)
+# packing lines by name, the first one also serves the routes without a line prefix
+lines: Dict[str, PackingLine] = {}
+# keyword arguments of `start_marker`, set from the command line
+marker_options: dict = {}
+# the pipeline runs in the event loop of the web server
+marker_task: asyncio.Task | None = None
+# resources shared by the packing lines, released by `stop_marker`
+db_manager: DatabaseManager | None = None
+decode_executor: DecodeExecutor | None = None
+# stops the web server, on a signal or when the packing lines fail
+shutdown_event = asyncio.Event()
+
+
+def create_lines(line_configs: List[LineConfig], executor: DecodeExecutor, database: DatabaseManager,
+                 tile_workers: int = 0, preprocessor: FramePreprocessor | None = None, auto_tune: bool = False,
+                 frame_buffer_size: int = 2, frame_buffer_policy: str = 'drop_oldest',
+                 preview_fps: float = 5.0, preview_quality: int = 50, record_dir: str | None = None,
+                 replay_realtime: bool = True, replay_loop: bool = False) -> None:
+    # every line gets an equal share of the decode workers, so a busy camera can not starve the others
+    max_in_flight = max(executor.workers // len(line_configs), 1)
+    for config in line_configs:
+        results_dir = 'results' if len(line_configs) == 1 else os.path.join('results', config.name)
+        lines[config.name] = PackingLine(config, db_manager=database, decode_executor=executor,
+                                         max_in_flight=max_in_flight, results_dir=results_dir,
+                                         tile_workers=tile_workers, preprocessor=preprocessor, auto_tune=auto_tune,
+                                         frame_buffer_size=frame_buffer_size,
+                                         frame_buffer_policy=FrameBufferPolicy(frame_buffer_policy),
+                                         preview_fps=preview_fps, preview_quality=preview_quality,
+                                         record_dir=record_dir, replay_realtime=replay_realtime,
+                                         replay_loop=replay_loop)
+
+
+def close_lines() -> None:
+    global db_manager, decode_executor
+    if decode_executor is not None:
+        decode_executor.shutdown()
+        decode_executor = None
+    for line in lines.values():
+        line.close()
+    lines.clear()
+    if db_manager is not None:
+        db_manager.close()
+        db_manager = None
+
+
+async def run_lines() -> None:
+    tasks = [asyncio.create_task(line.run(), name=f"line_{name}") for name, line in lines.items()]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        # one failed line stops the others, the server goes down with them
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def on_marker_done(task: asyncio.Task) -> None:
+    if task.cancelled():
+        return
+    exception = task.exception()
+    if exception is not None:
+        logging.critical("Линии упаковки остановлены из-за ошибки, сервер завершает работу",
+                         exc_info=(type(exception), exception, exception.__traceback__))
     else:
-        decoder = DataMatrixDecoderMock(url=url, max_count=expected_num, timeout=timeout,
-                                        callback=box_marker.process_detected_codes)
-    decoder.subscribe(box_marker)
-    await decoder.run()
+        logging.critical("Линии упаковки остановились, сервер завершает работу")
+    shutdown_event.set()
+
+
+@app.before_serving
+async def start_marker():
+    """Creates the packing lines before the server accepts requests, a failure here stops the server from starting"""
+    global marker_task, db_manager, decode_executor
+    options = dict(marker_options)
+    line_configs = options.pop('line_configs')
+    executor_kind = options.pop('decode_executor', 'process')
+    decode_workers = options.pop('decode_workers', None)
+    try:
+        db_manager = DatabaseManager()
+        decode_executor = create_decode_executor(executor_kind, decode_workers)
+        create_lines(line_configs, decode_executor, db_manager, **options)
+    except BaseException:
+        close_lines()
+        raise
+    marker_task = asyncio.create_task(run_lines())
+    marker_task.add_done_callback(on_marker_done)
+
+
+@app.after_serving
+async def stop_marker():
+    if marker_task is not None:
+        marker_task.cancel()
+        # a failure is already logged by `on_marker_done`
+        with suppress(asyncio.CancelledError, Exception):
+            await marker_task
+    close_lines()
+
+
+async def serve_app(config: Config) -> None:
+    loop = asyncio.get_running_loop()
+    for signal_name in ('SIGINT', 'SIGTERM'):
+        with suppress(NotImplementedError):
+            loop.add_signal_handler(getattr(signal, signal_name), shutdown_event.set)
+    await serve(app, config, shutdown_trigger=shutdown_event.wait)
+
+
+def get_line(name: str | None) -> PackingLine:
+    if name is None:
+        if not lines:
+            abort(503)
+        return next(iter(lines.values()))
+    if name not in lines:
+        abort(404)
+    return lines[name]
 
 
 @app.route('/')
-def index():
-    return send_file('templates/index.html')
+async def index():
+    return await send_file('templates/index.html')
+
 
+@app.route('/lines')
+async def get_lines():
+    return jsonify(lines=list(lines))
 
-@app.route('/region_image')
-def get_region_image():
-    return send_file('region.jpg', mimetype='image/jpeg')
+
+@app.route('/region_image', defaults={'line': None})
+@app.route('/lines/<line>/region_image')
+async def get_region_image(line):
+    # encoding takes a few milliseconds, keep it away from the decode pipeline
+    jpeg, etag = await asyncio.to_thread(get_line(line).preview.jpeg)
+    # the client already has this frame
+    if request.if_none_match.contains(etag):
+        response = Response(b'', status=304)
+    else:
+        response = Response(jpeg, mimetype='image/jpeg')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
 
 
-@app.route('/devices_status')
-async def get_devices_status():
-    devices_status = await box_marker.get_devices_status()
-    return jsonify(devices_status)
+@app.route('/devices_status', defaults={'line': None})
+@app.route('/lines/<line>/devices_status')
+async def get_devices_status(line):
+    packing_line = get_line(line)
+    devices_status = await packing_line.box_marker.get_devices_status()
+    return jsonify(**devices_status, frame_buffer=packing_line.get_frame_stats(),
+                   file_writer=packing_line.file_saver.get_stats())
 
 
-@app.route('/state')
-async def get_state():
-    state = await box_marker.get_state()
+@app.route('/state', defaults={'line': None})
+@app.route('/lines/<line>/state')
+async def get_state(line):
+    state = await get_line(line).box_marker.get_state()
     return jsonify(state)
 
 
-@app.route('/detected_codes')
-async def get_detected_codes():
-    detected_codes = box_marker.get_detected_codes()
+@app.route('/detected_codes', defaults={'line': None})
+@app.route('/lines/<line>/detected_codes')
+async def get_detected_codes(line):
+    detected_codes = [code.to_base64() for code in get_line(line).box_marker.get_detected_codes()]
     return jsonify(detected_codes=detected_codes, detected_count=len(detected_codes))
 
 
-@app.route('/collected_codes')
-async def get_collected_codes():
-    collected_codes = box_marker.get_collected_codes()
+@app.route('/collected_codes', defaults={'line': None})
+@app.route('/lines/<line>/collected_codes')
+async def get_collected_codes(line):
+    collected_codes = [code.to_base64() for code in get_line(line).box_marker.get_collected_codes()]
     return jsonify(collected_codes=collected_codes, collected_count=len(collected_codes))
 
 
-@app.route('/reset', methods=['POST'])
-def reset():
-    global box_marker
-    box_marker.reset()
+@app.route('/snapshot', defaults={'line': None})
+@app.route('/lines/<line>/snapshot')
+async def get_snapshot(line):
+    """Everything the web interface shows, for the first render and for reconnects"""
+    version, snapshot = get_line(line).box_marker.live_updates.snapshot()
+    return jsonify(version=version, **snapshot)
+
+
+@app.route('/events', defaults={'line': None})
+@app.route('/lines/<line>/events')
+async def get_events(line):
+    """Server-sent events with a snapshot each time it changes"""
+    live_updates = get_line(line).box_marker.live_updates
+
+    async def stream():
+        version, snapshot = live_updates.snapshot()
+        yield f"id: {version}\ndata: {json.dumps(snapshot)}\n\n".encode()
+        while True:
+            new_version, snapshot = await live_updates.wait(version, timeout=15)
+            if new_version == version:
+                # keeps proxies from closing an idle connection
+                yield b": keepalive\n\n"
+                continue
+            version = new_version
+            yield f"id: {version}\ndata: {json.dumps(snapshot)}\n\n".encode()
+
+    response = Response(stream(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+    # the stream lasts as long as the client is connected
+    response.timeout = None
+    return response
+
+
+@app.route('/reset', methods=['POST'], defaults={'line': None})
+@app.route('/lines/<line>/reset', methods=['POST'])
+async def reset(line):
+    get_line(line).box_marker.reset()
     return '', 204
 
 
-def start_flask():
-    app.run(host='0.0.0.0', port=http_port)
+@app.route('/transitions', defaults={'line': None})
+@app.route('/lines/<line>/transitions')
+async def get_transitions(line):
+    box_marker = get_line(line).box_marker
+    limit = min(request.args.get('limit', 100, type=int), 1000)
+    transitions = [transition._asdict() for transition in box_marker.get_transitions(limit)]
+    cycle_times = box_marker.get_cycle_times()
+    return jsonify(transitions=transitions, boxes=len(cycle_times),
+                   cycle_time_avg=sum(cycle_times) / len(cycle_times) if cycle_times else None,
+                   cycle_time_last=cycle_times[-1] if cycle_times else None)
+
+
+@app.route('/history')
+async def get_history():
+    # all lines share one database, read it on a reader connection outside of the event loop
+    limit = min(request.args.get('limit', 50, type=int), 1000)
+    offset = request.args.get('offset', 0, type=int)
+    boxes = await asyncio.to_thread(get_line(None).box_marker.db_manager.get_history, limit=limit, offset=offset)
+    history = [{"group_code": box["group_code"].to_base64(), "created_at": box["created_at"],
+                "individual_codes": [code.to_base64() for code in box["individual_codes"]]}
+               for box in boxes]
+    return jsonify(history=history, count=len(history))
+
+
+@app.route('/metrics')
+async def get_metrics():
+    # Prometheus text exposition format, metrics of all lines
+    return Response(REGISTRY.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
 
 
 def parse_args():
     parser = argparse.ArgumentParser(description='Запуск приложения с параметрами.')
-    parser.add_argument('--url', type=str, required=True, help='URL для получения изображения')
+    parser.add_argument('--url', type=str, required=False, help='URL для получения изображения')
     parser.add_argument('--timeout', type=int, required=False, default=2, help='Таймаут для декодирования DataMatrix')
-    parser.add_argument('--expected_num', type=int, required=True, help='Ожидаемое количество бутылок')
+    parser.add_argument('--expected_num', type=int, required=False, help='Ожидаемое количество бутылок')
+    parser.add_argument('--lines', type=str, required=False, default=None,
+                        help='JSON файл со списком линий (name, url, expected_num, timeout, max_failed_attempts) '
+                             'вместо --url и --expected_num')
+    parser.add_argument('--frame_source', type=str, choices=FRAME_SOURCE_KINDS, default='snapshot',
+                        help='Получение кадров: отдельный снимок на каждый кадр или постоянный MJPEG/RTSP поток')
     parser.add_argument('--http_port', type=str, required=False, default=8001, help='Порт для запуска бэка')
     parser.add_argument('--log_level', type=str, choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
                         default='INFO', help='Уровень логирования')
-    parser.add_argument('--test', action='store_true', help='Тестовый режим')
+    parser.add_argument('--record', type=str, default=None,
+                        help='Директория для записи кадров камер, записи воспроизводятся через --replay')
+    parser.add_argument('--replay', type=str, default=None,
+                        help='Файл записи кадров, воспроизводимый вместо камеры (вместо --url)')
+    parser.add_argument('--replay_speed', type=str, choices=['realtime', 'max'], default='realtime',
+                        help='Воспроизводить кадры с записанной скоростью или так быстро, как они распознаются '
+                             '(вместе с --frame_buffer_policy block)')
+    parser.add_argument('--replay_loop', action='store_true', help='Воспроизводить запись по кругу')
     parser.add_argument('--max_failed_attempts', type=int, default=2,
                         help='Максимальное количество попыток распознавания кодов на изображении')
-    return parser.parse_args()
+    parser.add_argument('--decode_executor', type=str, choices=DECODE_EXECUTOR_KINDS, default='process',
+                        help='Где выполнять декодирование: пул процессов, пул потоков или в цикле событий (отладка)')
+    parser.add_argument('--decode_workers', type=int, default=None,
+                        help='Количество параллельно декодируемых кадров (по умолчанию по числу ядер)')
+    parser.add_argument('--tile_workers', type=int, default=0,
+                        help='Количество потоков для декодирования одного кадра по частям (0 - кадр целиком)')
+    parser.add_argument('--imread_mode', type=str, choices=list(IMREAD_MODES), default='unchanged',
+                        help='Режим декодирования JPEG: как есть, в оттенках серого или уменьшенный в 2/4 раза')
+    parser.add_argument('--clahe', action='store_true', help='Выравнивать контраст кадра (CLAHE)')
+    parser.add_argument('--adaptive_threshold', action='store_true', help='Бинаризовать кадр адаптивным порогом')
+    parser.add_argument('--module_size', type=float, default=None,
+                        help='Ожидаемый размер модуля кода в пикселях кадра, по нему кадр уменьшается перед '
+                             'декодированием')
+    parser.add_argument('--auto_tune', action='store_true',
+                        help='Подбирать параметры libdmtx по размерам распознанных кодов')
+    parser.add_argument('--frame_buffer_size', type=int, default=2,
+                        help='Максимальное количество кадров, ожидающих распознавания')
+    parser.add_argument('--frame_buffer_policy', type=str, choices=[str(p) for p in FrameBufferPolicy],
+                        default=str(FrameBufferPolicy.DROP_OLDEST),
+                        help='Что делать с новым кадром при заполненном буфере: вытеснить самый старый, '
+                             'хранить только последний или ждать освобождения места')
+    parser.add_argument('--preview_fps', type=float, default=5.0,
+                        help='Не чаще скольких раз в секунду кодировать кадр для веб-интерфейса')
+    parser.add_argument('--preview_quality', type=int, default=50, help='Качество JPEG кадра для веб-интерфейса')
+    args = parser.parse_args()
+    if args.replay:
+        if args.lines:
+            parser.error('--replay задаёт запись для одной линии, в --lines укажите "source": "replay" и '
+                         'путь к записи в "url"')
+        args.url, args.frame_source = args.replay, 'replay'
+    if args.lines is None and (args.url is None or args.expected_num is None):
+        parser.error('необходимо задать --lines или --url (--replay) и --expected_num')
+    return args
 
 
 def main():
-    global http_port
     args = parse_args()
 
     # also save logs to file with filename as current date and time in results folder
@@ -107,12 +331,32 @@ def main():
         ]
     )
 
-    http_port = args.http_port
-    flask_thread = threading.Thread(target=start_flask)
-    flask_thread.start()
+    if args.lines:
+        line_configs = load_line_configs(args.lines, timeout=args.timeout * 1000,
+                                         max_failed_attempts=args.max_failed_attempts, source=args.frame_source)
+    else:
+        line_configs = [LineConfig(name='default', url=args.url, expected_num=args.expected_num,
+                                   timeout=args.timeout * 1000, max_failed_attempts=args.max_failed_attempts,
+                                   source=args.frame_source)]
+
+    marker_options.update(
+        line_configs=line_configs,
+        decode_executor=args.decode_executor, decode_workers=args.decode_workers,
+        tile_workers=args.tile_workers,
+        preprocessor=FramePreprocessor(imread_mode=args.imread_mode, clahe=args.clahe,
+                                       adaptive_threshold=args.adaptive_threshold,
+                                       module_size=args.module_size),
+        auto_tune=args.auto_tune,
+        frame_buffer_size=args.frame_buffer_size, frame_buffer_policy=args.frame_buffer_policy,
+        preview_fps=args.preview_fps, preview_quality=args.preview_quality,
+        record_dir=args.record, replay_realtime=args.replay_speed == 'realtime', replay_loop=args.replay_loop)
 
-    asyncio.run(
-        run_marker(url=args.url, timeout=args.timeout * 1000, expected_num=args.expected_num, max_failures=args.max_failed_attempts, test=args.test))
+    config = Config()
+    config.bind = [f"0.0.0.0:{args.http_port}"]
+    # the web server and the packing lines share one event loop, the lines are started by `start_marker`
+    asyncio.run(serve_app(config))
+    if marker_task is not None and not marker_task.cancelled() and marker_task.exception() is not None:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
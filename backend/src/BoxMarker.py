@@ -1,30 +1,49 @@
 from __future__ import annotations
 
+import asyncio
+import time
+from collections import deque
 from datetime import datetime
-import threading
 import logging
 
-from backend.src.Codes2XML import generate_xml
-from backend.src.Codes2TXT import generate_csv
 from backend.src.DatabaseManager import DatabaseManager
 from backend.src.StatusObservable import DeviceObserver
 from backend.src.status import DevicesStatusesHandler
-from backend.src.code_checkers import is_km_valid, is_ka_valid
-from typing import ClassVar, List
+from backend.src.code_checkers import is_km_valid, is_ka_valid, ka_fields, parse_ka, parse_km
+from backend.src.metrics import CYCLE_SECONDS, EVENT_SECONDS, INBOX_DEPTH, TRANSITIONS, VALIDATION_SECONDS
+from typing import Callable, ClassVar, List, NamedTuple, Set, Tuple
 
 from backend.src.FileSaver import FileSaver
+from backend.src.LiveUpdates import LiveUpdates
+from backend.src.MarkingCode import MarkingCode
+
+
+# how many new codes a state needs, the codes it already has and a predicate on the raw bytes of the codes which
+# count as new, `None` for any code. The predicate is sent to the decode workers, so it has to be picklable.
+DecodeRequest = Tuple[int | None, Set[MarkingCode], Callable[[bytes], object] | None]
+
+
+class Transition(NamedTuple):
+    """Entry of the transition journal"""
+    # epoch seconds
+    time: float
+    from_state: str
+    to_state: str
+    # seconds from the first code of the box to its aggregation, set on the transition finishing the box
+    cycle_time: float | None = None
 
 
 class State:
-    _box_marker: BoxMarker | None = None
-    _detected_codes: List[str] = []
-    _detected_group_code: str | None = None
+    _box_marker: BoxMarker | None
+    _detected_codes: List[MarkingCode]
+    _detected_group_code: MarkingCode | None
     name: ClassVar[str] = "НЕОПРЕДЕЛЕНО"
     code: ClassVar[int] = 0
 
     def __init__(self, other_state: State = None) -> None:
-        self._lock = threading.Lock()
-
+        self._box_marker = None
+        self._detected_codes = []
+        self._detected_group_code = None
         if other_state:
             self._detected_codes = other_state.detected_codes
             self._detected_group_code = other_state._detected_group_code
@@ -51,16 +70,24 @@ class State:
     def detected_group_code(self):
         return self._detected_group_code
 
-    def process_detected_codes(self, codes: List[str]) -> None:
-        with self._lock:
-            logging.info(f"Состояние: {self.name}.\tПрочитано кодов в кадре: {len(codes):2d}")
-            # for code in codes:
-            #     logging.info(code[-7:-1])
-            self._process_detected_codes(codes)
+    def process_detected_codes(self, codes: List[MarkingCode]) -> None:
+        logging.info(f"Состояние: {self.name}.\tПрочитано кодов в кадре: {len(codes):2d}")
+        # for code in codes:
+        #     logging.info(code[-7:-1])
+        self._process_detected_codes(codes)
 
-    def _process_detected_codes(self, codes: List[str]) -> None:
+    def _process_detected_codes(self, codes: List[MarkingCode]) -> None:
         pass
 
+    def _valid_codes(self, codes: List[MarkingCode], is_valid: Callable[[MarkingCode], bool]) -> List[MarkingCode]:
+        with VALIDATION_SECONDS.time(line=self._box_marker.line):
+            return [code for code in codes if is_valid(code)]
+
+    def decode_request(self) -> DecodeRequest:
+        """How many codes missing from the returned set the state needs to make a decision.
+        `None` means that the whole frame has to be scanned."""
+        return None, set(), None
+
     def do_job_once(self):
         pass
 
@@ -73,14 +100,18 @@ class ReadyState(State):
         self._detected_codes = []
         self._detected_group_code = None
 
+    def decode_request(self) -> DecodeRequest:
+        # the whole frame is scanned for bottle codes
+        return None, set(), parse_km
+
     def _process_detected_codes(self, codes):
-        valid_codes = [code for code in codes if is_km_valid(code)]
+        valid_codes = self._valid_codes(codes, is_km_valid)
         logging.info(f"Состояние: {self.name}.\tВалидных кодов: {len(valid_codes)}")
         if 0 < len(valid_codes) <= self._box_marker.expected_bottles_number:
             # save only valid codes
             self._detected_codes = valid_codes
             # Check for duplicate codes in the database
-            duplicates_exist = any(self._box_marker.db_manager.is_individual_code_exists(code) for code in codes)
+            duplicates_exist = bool(self._box_marker.db_manager.existing_individual_codes(codes))
             if duplicates_exist:
                 self._box_marker.set_state(DuplicateCodeError)
                 return
@@ -115,7 +146,7 @@ class CollectingCodesState(State):
                 return
         else:
             self._zero_count = 0
-        valid_codes = [code for code in codes if is_km_valid(code)]
+        valid_codes = self._valid_codes(codes, is_km_valid)
         logging.info(f"Состояние: {self.name}.\tВалидных кодов: {len(valid_codes)}")
         union_codes = set(self._detected_codes).union(set(valid_codes))
         logging.info(
@@ -129,8 +160,8 @@ class CollectingCodesState(State):
             return
         elif len(union_codes) == self._box_marker.expected_bottles_number:
             # Check for duplicate codes in the database
-            duplicates_exist = any(self._box_marker.db_manager.is_individual_code_exists(code) for code in union_codes)
-            duplicates_exist |= any(self._box_marker.db_manager.is_group_code_exists(code) for code in union_codes)
+            duplicates_exist = bool(self._box_marker.db_manager.existing_individual_codes(union_codes) or
+                                    self._box_marker.db_manager.existing_group_codes(union_codes))
             self._detected_codes = list(union_codes)
             if duplicates_exist:
                 self._box_marker.set_state(DuplicateCodeError)
@@ -138,6 +169,11 @@ class CollectingCodesState(State):
             self._box_marker.set_state(CollectSingleGroupCode)
             return
 
+    def decode_request(self) -> DecodeRequest:
+        # only new bottle codes bring the box closer, the scan stops once they complete it
+        missing = self._box_marker.expected_bottles_number - len(self._detected_codes)
+        return (missing if missing > 0 else None), set(self._detected_codes), parse_km
+
 
 class TooMuchCodesState(ReadyState):
     name = "СЛИШКОМ МНОГО КОДОВ В КАДРЕ"
@@ -149,10 +185,14 @@ class CollectSingleGroupCode(State):
     code = 3
 
     def _process_detected_codes(self, codes):
-        valid_codes = [code for code in codes if is_ka_valid(code)]
+        valid_codes = self._valid_codes(codes, is_ka_valid)
         logging.info(f"Состояние: {self.name}.\tВалидных кодов: {len(valid_codes):2d}")
         if len(valid_codes) == 1:
             self._detected_group_code = valid_codes[0]
+            count = ka_fields(self._detected_group_code).count
+            if count != self._box_marker.expected_bottles_number:
+                logging.warning(f"Код агрегации рассчитан на {count} бутылок, "
+                                f"а в коробке {self._box_marker.expected_bottles_number}")
             # Check if the group code already exists in the database
             if self._box_marker.db_manager.is_group_code_exists(self._detected_group_code):
                 self._box_marker.set_state(DuplicateCodeError)
@@ -164,6 +204,10 @@ class CollectSingleGroupCode(State):
             self.box_marker.set_state(TooMuchCodesState)
             return
 
+    def decode_request(self) -> DecodeRequest:
+        # the whole frame is scanned, a second aggregation code makes it TooMuchCodesState
+        return None, set(), parse_ka
+
 
 class CreateAndPublishXML(State):
     name = "СОЗДАЮ И СОХРАНЯЮ XML"
@@ -184,12 +228,9 @@ class CreateAndPublishXML(State):
         logging.info(f"Код агрегации: {self._detected_group_code}")
         current_day = datetime.today().strftime('%d%m%Y')
         filename = f"{seq:04d}_{current_day}"
-        logging.info(f"Создаю и сохраняю XML файл {filename}.xml")
-        xml_file = generate_xml(self._detected_codes, self._detected_group_code)
-        self._box_marker.write_file(xml_file, f"{filename}.xml", 'xml')
-        logging.info(f"Создаю и сохраняю CSV файл {filename}.csv")
-        csv_file = generate_csv(self._detected_codes, self._detected_group_code)
-        self._box_marker.write_file(csv_file, f"{filename}.csv", 'csv')
+        # the codes are already reserved in the database, XML and CSV files are written in the background
+        logging.info(f"Ставлю в очередь запись файлов {filename}.xml и {filename}.csv")
+        self._box_marker.save_aggregation(filename, self._detected_codes, self._detected_group_code)
         self._box_marker.set_state(WaitForNextBox)
         return
 
@@ -203,10 +244,10 @@ class DuplicateCodeError(State):
     name = "ОШИБКА: РАНЕЕ УЧТЕННЫЙ КОД В КАДРЕ"
     code = -2
 
-    def _process_detected_codes(self, codes: List[str]) -> None:
+    def _process_detected_codes(self, codes: List[MarkingCode]) -> None:
         # if there is no longer duplicate codes, return to the Ready state
-        if not any(self._box_marker.db_manager.is_individual_code_exists(code) for code in codes) and \
-                not any(self._box_marker.db_manager.is_group_code_exists(code) for code in codes):
+        if not self._box_marker.db_manager.existing_individual_codes(codes) and \
+                not self._box_marker.db_manager.existing_group_codes(codes):
             self._box_marker.set_state(ReadyState)
             return
 
@@ -215,59 +256,154 @@ class WaitForNextBox(State):
     name = "ОЖИДАНИЕ СЛЕДУЮЩЕЙ КОРОБКИ"
     code = 5
 
-    def _process_detected_codes(self, codes: List[str]) -> None:
+    def _process_detected_codes(self, codes: List[MarkingCode]) -> None:
         if len(codes) == 0:
             self._box_marker.set_state(ReadyState)
             return
 
+    def decode_request(self) -> DecodeRequest:
+        # a single bottle code is enough to know the box is still here
+        return 1, set(), parse_km
+
 
 class BoxMarker(DeviceObserver):
+    """State machine of the box being aggregated.
+
+    The state machine is owned by `run`: detected codes, device statuses and resets are queued to its inbox and
+    applied one by one on the event loop, so no locking is needed. Every transition is kept in a bounded journal.
+    """
     _state: State
     expected_bottles_number: int
     file_saver: FileSaver | None = None
     _devices_status_handler: DevicesStatusesHandler
     db_manager: DatabaseManager
-    latest_codes: List[str] = []
+    latest_codes: List[MarkingCode]
 
-    def __init__(self, file_saver: FileSaver, expected_bottles_number: int, max_failed_attempts: int) -> None:
+    def __init__(self, file_saver: FileSaver, expected_bottles_number: int, max_failed_attempts: int,
+                 db_manager: DatabaseManager | None = None, inbox_size: int = 16, journal_size: int = 1000,
+                 line: str = 'default') -> None:
+        # packing line of the box, labels the metrics
+        self.line = line
         self.expected_bottles_number = expected_bottles_number
         self._file_saver = file_saver
-        self.db_manager = DatabaseManager()
-        self._state = ReadyState()
-        self.reset()
+        # several packing lines share one database, so that a code can not be aggregated twice
+        self.db_manager = db_manager if db_manager else DatabaseManager()
         self._devices_status_handler = DevicesStatusesHandler()
         self.max_failed_attempts = max_failed_attempts
-
-    def __del__(self):
-        self.set_state(ReadyState)
-        self.reset()
+        self.latest_codes = []
+        # events waiting for the state machine: (kind, payload). Statuses and resets always get in,
+        # frames wait while `inbox_size` of them are queued.
+        self._inbox = asyncio.Queue()
+        self._frame_slots = asyncio.Semaphore(inbox_size)
+        INBOX_DEPTH.set_function(self._inbox.qsize, line=line)
+        self.transitions = deque(maxlen=journal_size)
+        # when the first codes of the current box were seen
+        self._cycle_started: float | None = None
+        # pushed to the web interface whenever what it shows changes
+        self.live_updates = LiveUpdates()
+        self._published = None
+        # boxes aggregated by the current event: file name, codes and group code in base64
+        self._aggregations: List[Tuple[str, List[str], str]] = []
+        self._state = ReadyState()
+        self._reset()
+
+    async def run(self):
+        while True:
+            kind, payload = await self._inbox.get()
+            started = time.perf_counter()
+            try:
+                if kind == 'codes':
+                    self.latest_codes = payload
+                    self._state.process_detected_codes(payload)
+                elif kind == 'status':
+                    self._update_devices(payload)
+                elif kind == 'reset':
+                    self._reset()
+                self._publish()
+                # the next event waits for the journal, so a slow disk holds the frames back
+                await self._save_aggregations()
+            except Exception as e:
+                logging.error(f"Ошибка обработки события {kind}: {e}")
+            finally:
+                if kind == 'codes':
+                    self._frame_slots.release()
+                self._inbox.task_done()
+                EVENT_SECONDS.observe(time.perf_counter() - started, line=self.line, kind=kind)
 
     def set_state(self, state: type[State]):
         if not issubclass(state, State):
             raise ValueError("State must be a subclass of State")
         if not isinstance(self._state, state):
             logging.info(f"Запланирован переход состояния `{self._state.name}` -> `{state.name}`")
+            previous = self._state
             if not isinstance(self._state, ErrorState):
                 self._state = state(self._state)
             elif not self._devices_status_handler.is_error():
                 self._state = state(self._state)
+            if self._state is not previous:
+                self._journal(previous, self._state)
             self._state.do_job_once()
             logging.info(f"Выполнен переход в состояние {self._state.name}")
+            self._publish()
+
+    def _journal(self, previous: State, state: State):
+        now = time.time()
+        cycle_time = None
+        if isinstance(state, (CollectingCodesState, CollectSingleGroupCode)) and self._cycle_started is None:
+            self._cycle_started = now
+        elif isinstance(state, WaitForNextBox) and self._cycle_started is not None:
+            cycle_time = now - self._cycle_started
+            self._cycle_started = None
+            CYCLE_SECONDS.observe(cycle_time, line=self.line)
+        elif isinstance(state, (ReadyState, ErrorState, DuplicateCodeError)):
+            # the box is abandoned
+            self._cycle_started = None
+        self.transitions.append(Transition(now, previous.name, state.name, cycle_time))
+        TRANSITIONS.inc(line=self.line, from_state=type(previous).__name__, to_state=type(state).__name__)
 
     def update_devices(self, status):
+        self._inbox.put_nowait(('status', status))
+
+    def _update_devices(self, status):
         self._devices_status_handler.handle_status(status)
         if self._devices_status_handler.is_error():
             self.set_state(ErrorState)
         elif isinstance(self._state, ErrorState):
-            self.reset()
+            self._reset()
 
     async def process_detected_codes(self, codes: List) -> None:
-        self.latest_codes = codes
-        self._state.process_detected_codes(codes)
-
-    def write_file(self, xml_file_content: str, filename: str, subdir: str | None = None) -> None:
+        await self._frame_slots.acquire()
+        self._inbox.put_nowait(('codes', codes))
+
+    def _publish(self):
+        collected_codes = self.get_collected_codes()
+        statuses = self._devices_status_handler.get_statuses()
+        # cheap comparison first, codes are only encoded when something has changed
+        published = (self._state.code, tuple(statuses.items()), tuple(self.latest_codes), tuple(collected_codes))
+        if published == self._published:
+            return
+        self._published = published
+        self.live_updates.publish({
+            "state": {"name": self._state.name, "code": self._state.code},
+            "devices_status": statuses,
+            "detected_codes": {"detected_codes": [code.to_base64() for code in self.latest_codes],
+                               "detected_count": len(self.latest_codes)},
+            "collected_codes": {"collected_codes": [code.to_base64() for code in collected_codes],
+                                "collected_count": len(collected_codes)},
+        })
+
+    def save_aggregation(self, filename: str, codes: List[MarkingCode], group_code: MarkingCode) -> None:
         if self._file_saver:
-            self._file_saver.save_file(filename, xml_file_content, subdir)
+            # exported files keep codes as base64 text
+            self._aggregations.append((filename, [code.to_base64() for code in codes], group_code.to_base64()))
+
+    async def _save_aggregations(self):
+        while self._aggregations:
+            filename, codes, group_code = self._aggregations.pop(0)
+            await self._file_saver.save_aggregation(filename, codes, group_code)
+
+    def get_decode_request(self) -> DecodeRequest:
+        return self._state.decode_request()
 
     async def get_state(self) -> dict:
         return {"name": self._state.name, "code": self._state.code}
@@ -275,15 +411,25 @@ class BoxMarker(DeviceObserver):
     async def get_devices_status(self) -> dict:
         return self._devices_status_handler.get_statuses()
 
-    def get_detected_codes(self) -> List[str]:
+    def get_detected_codes(self) -> List[MarkingCode]:
         return self.latest_codes
 
-    def get_collected_codes(self) -> List[str]:
+    def get_collected_codes(self) -> List[MarkingCode]:
         if isinstance(self._state, CollectingCodesState):
             return self._state.detected_codes
         else:
             return []
 
+    def get_transitions(self, limit: int = 100) -> List[Transition]:
+        return list(self.transitions)[-limit:]
+
+    def get_cycle_times(self) -> List[float]:
+        return [transition.cycle_time for transition in self.transitions if transition.cycle_time is not None]
+
     def reset(self):
+        self._inbox.put_nowait(('reset', None))
+
+    def _reset(self):
         self._state.reset(self)
         self.set_state(ReadyState)
+        self._publish()
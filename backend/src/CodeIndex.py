@@ -0,0 +1,72 @@
+import hashlib
+import math
+from collections import OrderedDict
+from typing import Iterable, Set, Tuple
+
+
+def _key(code) -> bytes:
+    return code.encode('utf-8') if isinstance(code, str) else bytes(code)
+
+
+class BloomFilter:
+    """Set membership test without false negatives and with about `error_rate` false positives while it holds
+    no more than `capacity` items"""
+
+    def __init__(self, capacity: int, error_rate: float = 0.001):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self._size = max(int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)), 8)
+        self._hashes = max(int(round(self._size / capacity * math.log(2))), 1)
+        self._bits = bytearray((self._size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, code):
+        digest = hashlib.blake2b(_key(code), digest_size=16).digest()
+        # double hashing: k positions out of two independent 64 bit hashes
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self._size for i in range(self._hashes)]
+
+    def add(self, code) -> None:
+        for position in self._positions(code):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, code) -> bool:
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(code))
+
+    @property
+    def is_overfilled(self) -> bool:
+        return self.count > self.capacity
+
+
+class CodeIndex:
+    """In-memory index of codes stored in a database table: a Bloom filter over all of them answers most
+    lookups negatively without touching the database, a bounded set of recently seen codes answers
+    positively. Only Bloom filter hits missing from the recent set have to be confirmed by the database."""
+
+    def __init__(self, capacity: int = 5_000_000, error_rate: float = 0.001, recent_size: int = 100_000):
+        self.bloom = BloomFilter(capacity, error_rate)
+        self.recent_size = recent_size
+        self._recent = OrderedDict()
+
+    def add(self, code) -> None:
+        self.bloom.add(code)
+        self.remember(code)
+
+    def remember(self, code) -> None:
+        """Mark a code known to exist in the database as recently seen"""
+        self._recent[code] = None
+        self._recent.move_to_end(code)
+        if len(self._recent) > self.recent_size:
+            self._recent.popitem(last=False)
+
+    def lookup(self, codes: Iterable) -> Tuple[Set, Set]:
+        """Returns the codes which surely exist and the codes which may exist. Other codes surely do not."""
+        existing, possible = set(), set()
+        for code in codes:
+            if code in self._recent:
+                existing.add(code)
+            elif code in self.bloom:
+                possible.add(code)
+        return existing, possible
@@ -1,10 +1,10 @@
-import base64
 from asyncio import Queue
-import shutil
+from collections import deque
+import time
+from typing import Callable, Dict
 
 import cv2
 import numpy
-import httpx
 import asyncio
 import logging
 import logging.config
@@ -12,7 +12,17 @@ import logging.config
 from .pylibdmtx import pylibdmtx
 from httpx import DigestAuth
 
+from backend.src.DecodeExecutor import DecodeExecutor, create_decode_executor
+from backend.src.DecodeTuner import DecodeTuner
+from backend.src.FrameBuffer import FrameBuffer
+from backend.src.FramePreprocessor import FramePreprocessor, StageTimings, scale_region
+from backend.src.FrameSource import FrameSource, FrameUnavailableError, SnapshotFrameSource
+from backend.src.MarkingCode import MarkingCode
+from backend.src.PreviewService import PreviewService
+from backend.src.RegionTracker import RegionTracker
 from backend.src.StatusObservable import StatusObservable
+from backend.src.metrics import (CODES, DECODES_IN_FLIGHT, FRAME_BUFFER_DEPTH, FRAME_BUFFER_DROPPED, FRAME_ERRORS,
+                                 FRAMES, FRAMES_PER_SECOND, STAGE_SECONDS)
 from backend.src.status import DatamatrixDecoderStatus
 LOGGING_CONFIG = {
     "version": 1,
@@ -45,124 +55,289 @@ LOGGING_CONFIG = {
 logging.config.dictConfig(LOGGING_CONFIG)
 
 
+def mask_regions(image, decoded_messages_with_regions):
+    """Returns a copy of the image with already decoded codes painted over"""
+    masked = image.copy()
+    height = image.shape[0]
+    for msg in decoded_messages_with_regions:
+        points = numpy.array([(x, height - y) for x, y in msg.corners], dtype=numpy.int32)
+        cv2.fillConvexPoly(masked, points, (255, 255, 255))
+        # paint over the quiet zone too, otherwise its border looks like a code edge
+        cv2.polylines(masked, [points], True, (255, 255, 255), max(image.shape[:2]) // 100)
+    return masked
+
+
+def decode_frame(image, timeout: int, max_count: int, max_edge: int, tile_workers: int = 0, rois=(),
+                 preprocessor: FramePreprocessor | None = None, tuning: dict | None = None,
+                 deadline: float | None = None, needed: int | None = None, known=frozenset(), counts=None):
+    """Decode job executed by the decode executor, so it has to stay a picklable module-level function.
+
+    Regions of interest, where codes were seen on the previous frames, are decoded first. The full frame is
+    scanned only for the codes which were not found there. The scan stops at `deadline` (`time.time()` based,
+    `timeout` milliseconds from now by default) or as soon as `needed` codes missing from `known` are found.
+    Only the codes accepted by `counts`, a picklable predicate on the raw code bytes, count towards `needed`, and
+    only such codes found in the regions of interest count towards `max_count` when deciding whether to scan.
+
+    Region coordinates, `rois`, `max_edge` and the tuned libdmtx properties are in camera frame pixels. Returns
+    decoded codes with their regions and the time spent on every stage in milliseconds.
+    """
+    timings = {}
+    factor = 1.0
+    if deadline is None:
+        deadline = time.time() + timeout / 1000
+    params = {'max_edge': max_edge, **(tuning or {})}
+    if preprocessor:
+        image, factor = preprocessor.prepare(image, timings)
+        rois = [tuple(int(v / factor) for v in roi) for roi in rois]
+        for key in ('min_edge', 'max_edge', 'shrink'):
+            if key in params:
+                params[key] = max(int(params[key] / factor), 1)
+    found = []
+    started = time.perf_counter()
+    if rois:
+        found = pylibdmtx.decode_with_regions_in_rois(image, rois, deadline=deadline, max_count=max_count, **params)
+        timings['decode_rois'] = (time.perf_counter() - started) * 1000
+
+    def is_counted(data):
+        return counts is None or bool(counts(data))
+
+    def is_new(data):
+        return data not in known and is_counted(data)
+
+    # codes of another kind in the regions of interest, e.g. bottles while looking for the aggregation code, do not
+    # make the full frame scan unnecessary
+    counted = sum(1 for msg in found if is_counted(msg[0].data))
+    new_count = sum(1 for msg in found if is_new(msg[0].data))
+    if counted < max_count and (needed is None or new_count < needed):
+        if found:
+            image = mask_regions(image, found)
+        scan_started = time.perf_counter()
+        if tile_workers:
+            scanned = pylibdmtx.decode_with_regions_tiled(image, deadline=deadline, max_count=max_count - counted,
+                                                          workers=tile_workers, **params)
+        else:
+            scanned = pylibdmtx.iter_decode_with_regions(image, deadline=deadline,
+                                                         max_count=max_count - counted, **params)
+        seen = {msg[0].data for msg in found}
+        for msg in scanned:
+            if msg[0].data in seen:
+                continue
+            seen.add(msg[0].data)
+            found.append(msg)
+            if is_new(msg[0].data):
+                new_count += 1
+                # the state machine has got everything it is waiting for, no need to scan further
+                if needed is not None and new_count >= needed:
+                    break
+        timings['decode'] = (time.perf_counter() - scan_started) * 1000
+    if factor != 1.0:
+        found = [scale_region(msg, factor) for msg in found]
+    return found, timings
+
+
 class DataMatrixDecoder(StatusObservable):
-    def __init__(self, url: str, max_count: int, timeout: int, callback):
+    def __init__(self, url: str, max_count: int, timeout: int, callback,
+                 decode_executor: DecodeExecutor | None = None, tile_workers: int = 0,
+                 preprocessor: FramePreprocessor | None = None, tuners: Dict[Callable, DecodeTuner] | None = None,
+                 decode_request=None, max_in_flight: int | None = None, preview: PreviewService | None = None,
+                 frame_source: FrameSource | None = None, frame_buffer: FrameBuffer | None = None,
+                 line: str = 'default'):
         super().__init__()
         self.url = url
+        # packing line of the camera, labels the metrics
+        self.line = line
         self.max_count = max_count
         self.timeout = timeout
+        # number of threads scanning tiles of a single frame, 0 scans the whole frame at once
+        self.tile_workers = tile_workers
+        self.region_tracker = RegionTracker()
+        self.preprocessor = preprocessor if preprocessor else FramePreprocessor()
+        self.stage_timings = StageTimings()
+        # learned decode properties per kind of codes, keyed by the predicate the state counts its codes with
+        self.tuners = tuners if tuners else {}
         self.callback = callback
-        self.queue = Queue()
+        # returns how many new codes the consumer of the results is waiting for and which codes it already has
+        self.decode_request = decode_request
+        self.decode_executor = decode_executor if decode_executor else create_decode_executor()
+        # share of the executor this decoder may occupy, when the executor is shared between several cameras
+        self.max_in_flight = max_in_flight if max_in_flight else self.decode_executor.workers
+        self.preview = preview if preview else PreviewService()
+        # fetched frames waiting for a free decode slot
+        self.frame_buffer = frame_buffer if frame_buffer else FrameBuffer()
+        # frames in flight, in the order they were fetched
+        self.decoded_queue = Queue()
+        self.decode_slots = asyncio.Semaphore(self.max_in_flight)
         self.status = DatamatrixDecoderStatus.INIT
-        self.notify()
         self.set_no_image_available_picture()
-        self.client = None
-        self.auth = DigestAuth('admin', 'salek2025')
+        self.frame_source = frame_source if frame_source else SnapshotFrameSource(
+            url, self.preprocessor, auth=DigestAuth('admin', 'salek2025'))
         self.max_errors_count = 3
         self.error_count = 0
+        # when the last frames were decoded, for the frame rate
+        self._decoded_at = deque(maxlen=50)
+        FRAMES_PER_SECOND.set_function(self.frames_per_second, line=line)
+        FRAME_BUFFER_DEPTH.set_function(lambda: len(self.frame_buffer), line=line)
+        FRAME_BUFFER_DROPPED.set_function(lambda: self.frame_buffer.dropped, line=line)
+        DECODES_IN_FLIGHT.set_function(lambda: self.decoded_queue.qsize(), line=line)
 
-    def __del__(self):
-        if self.client:
-            self.client.aclose()
-
-    @staticmethod
-    def set_no_image_available_picture():
-        # copy no_image_available.jpg to region.jpg
-        shutil.copyfile('no_image_available.jpg', 'region.jpg')
-
+    def set_no_image_available_picture(self):
+        self.preview.set_unavailable()
 
     async def fetch_image(self):
         try:
-            if self.client is None:
-                self.client = httpx.AsyncClient(auth=self.auth)
-            # TODO: make it configurable
-            response = await self.client.get(self.url, timeout=1.0)
-            response.raise_for_status()
-            image_array = numpy.asarray(bytearray(response.content), dtype=numpy.uint8)
-            image = cv2.imdecode(image_array, cv2.IMREAD_UNCHANGED)
+            started = time.perf_counter()
+            image = await self.frame_source.read()
+            STAGE_SECONDS.observe(time.perf_counter() - started, line=self.line, stage='fetch')
             self.status = DatamatrixDecoderStatus.OK
             self.error_count = 0
             return image
-        except httpx.HTTPError as e:
+        except FrameUnavailableError as e:
+            FRAME_ERRORS.inc(line=self.line, kind='unavailable')
             logging.error(f"Кадр недоступен по сети: {e}")
             if self.error_count < self.max_errors_count:
                 self.error_count += 1
             else:
                 self.status = DatamatrixDecoderStatus.IMAGE_UNAVAILABLE
-                self.notify()
                 self.set_no_image_available_picture()
             return None
         except cv2.error as e:
+            FRAME_ERRORS.inc(line=self.line, kind='image')
             logging.error(f"Проблемы с обработкой кадра: {e}")
             if self.error_count < self.max_errors_count:
                 self.error_count += 1
             else:
                 self.status = DatamatrixDecoderStatus.GENERAL_FAILURE
-                self.notify()
                 self.set_no_image_available_picture()
 
     async def image_producer(self):
-        """Continuously fetch images and put them in the queue"""
+        """Continuously fetch images and put them in the frame buffer"""
         while True:
             try:
                 if self.status != DatamatrixDecoderStatus.IMAGE_UNAVAILABLE:
                     self.status = DatamatrixDecoderStatus.FETCHING_IMAGE
-                    self.notify()
                 image = await self.fetch_image()
                 if image is not None:
                     self.status = DatamatrixDecoderStatus.OK
-                    self.notify()
-                    await self.queue.put(image)
+                    await self.frame_buffer.put((image, self.frame_source.decode_ms))
                 else:
                     await asyncio.sleep(1.0)
             except Exception as e:
                 logging.error(f"Ошибка получения картинки: {e}")
                 self.status = DatamatrixDecoderStatus.GENERAL_FAILURE
-                self.notify()
                 self.set_no_image_available_picture()
 
     async def image_consumer(self):
-        """Process images from the queue"""
+        """Hand images from the frame buffer over to the decode executor"""
         while True:
+            # do not take more frames than the executor is able to decode in parallel, meanwhile
+            # the frame buffer keeps only the freshest frames
+            await self.decode_slots.acquire()
+            queued = False
             try:
-                image = await self.queue.get()
+                image, jpeg_decode_ms = await self.frame_buffer.get()
                 self.status = DatamatrixDecoderStatus.DECODING
-                self.notify()
-                decoded_messages_with_regions = self.decode_datamatrix(image)
-                codes = [base64.b64encode(msg[0].data).decode('utf-8') for msg in decoded_messages_with_regions]
-                image_size = image.shape[:2]
-                for region in decoded_messages_with_regions:
-                    coords = ()
-                    for i in range(4):
-                        coords += ((region[1][i][0], image_size[0] - region[1][i][1]),)
-                    cv2.polylines(image, [numpy.array(coords)], True, (0, 255, 0), max(image_size)//100)
-                cv2.imwrite('region.jpg', cv2.resize(image, (image_size[1]//3, image_size[0]//3), interpolation=cv2.INTER_AREA), [int(cv2.IMWRITE_JPEG_QUALITY), 50])
+                request = self.decode_request() if self.decode_request else (None, frozenset(), None)
+                job = asyncio.ensure_future(self.decode_datamatrix(image, request))
+                await self.decoded_queue.put((image, job, jpeg_decode_ms, request[2]))
+                queued = True
+            except Exception as e:
+                logging.error(f"Ошибка передачи кадра на распознавание: {e}")
+                self.status = DatamatrixDecoderStatus.GENERAL_FAILURE
+                self.set_no_image_available_picture()
+                await asyncio.sleep(0.1)
+            finally:
+                # `result_consumer` releases the slot of a queued frame once its codes are passed on
+                if not queued:
+                    self.decode_slots.release()
+
+    async def result_consumer(self):
+        """Pass decoded codes to the callback in the order the frames were fetched"""
+        while True:
+            image, job, jpeg_decode_ms, counts = await self.decoded_queue.get()
+            try:
+                decoded_messages_with_regions, timings = await job
+                timings = {'jpeg': jpeg_decode_ms, **timings}
+                self.stage_timings.add(timings, len(decoded_messages_with_regions))
+                self.observe_frame(timings, len(decoded_messages_with_regions))
+                self.region_tracker.update(decoded_messages_with_regions)
+                tuner = self.tuners.get(counts)
+                if tuner:
+                    # the tuner learns from the codes the state is looking for, other codes do not make progress
+                    tuner.observe([msg for msg in decoded_messages_with_regions if counts(msg[0].data)])
+                codes = [MarkingCode(msg[0].data) for msg in decoded_messages_with_regions]
+                # regions are in camera frame pixels, the fetched frame may be reduced
+                self.preview.update(image, decoded_messages_with_regions, self.preprocessor.reduction)
                 await self.callback(codes)
-                self.queue.task_done()
             except Exception as e:
+                FRAME_ERRORS.inc(line=self.line, kind='decode')
                 logging.error(f"Ошибка распознавания кодов: {e}")
                 self.status = DatamatrixDecoderStatus.GENERAL_FAILURE
-                self.notify()
                 self.set_no_image_available_picture()
                 await asyncio.sleep(0.1)
+            finally:
+                self.decode_slots.release()
+                self.decoded_queue.task_done()
+
+    def get_frame_stats(self) -> dict:
+        return self.frame_buffer.get_stats()
+
+    def observe_frame(self, timings: dict, codes_count: int) -> None:
+        """Records stage timings of a decoded frame, in milliseconds, to the metrics"""
+        for stage, ms in timings.items():
+            STAGE_SECONDS.observe(ms / 1000, line=self.line, stage=stage)
+        FRAMES.inc(line=self.line)
+        CODES.inc(codes_count, line=self.line)
+        self._decoded_at.append(time.monotonic())
+
+    def frames_per_second(self) -> float | None:
+        decoded_at = self._decoded_at
+        if not decoded_at:
+            return None
+        if len(decoded_at) < 2 or time.monotonic() - decoded_at[-1] > 5:
+            # nothing decoded lately
+            return 0.0
+        return (len(decoded_at) - 1) / max(decoded_at[-1] - decoded_at[0], 1e-6)
+
+    async def decode_datamatrix(self, image, request):
+        # the whole job: waiting for a worker, transferring the frame and decoding it
+        with STAGE_SECONDS.time(line=self.line, stage='job'):
+            return await self._decode_datamatrix(image, request)
+
+    async def _decode_datamatrix(self, image, request):
+        needed, known, counts = request
+        tuner = self.tuners.get(counts)
+        return await self.decode_executor.run(decode_frame, image, timeout=self.timeout,
+                                              deadline=time.time() + self.timeout / 1000,
+                                              needed=needed, known=frozenset(code.data for code in known),
+                                              counts=counts,
+                                              max_count=self.max_count, max_edge=200,
+                                              tile_workers=self.tile_workers,
+                                              rois=self.region_tracker.rois(self.frame_size(image)),
+                                              preprocessor=self.preprocessor,
+                                              tuning=tuner.params if tuner else None)
 
-    def decode_datamatrix(self, image):
-        return pylibdmtx.decode_with_regions(image, timeout=self.timeout, max_count=self.max_count, max_edge=200)
+    def frame_size(self, image):
+        """Size of the camera frame the image was decoded from"""
+        reduction = self.preprocessor.reduction
+        return image.shape[0] * reduction, image.shape[1] * reduction
 
     async def run(self):
         """Start both producer and consumer coroutines"""
         while True:
             try:
-                if self.client:
-                    await self.client.aclose()
-                self.client = httpx.AsyncClient(auth=self.auth)
+                await self.frame_source.close()
+                await self.frame_source.open()
+                # frames left over from the failed run would hold decode slots forever
+                self.frame_buffer.clear()
+                self.decoded_queue = Queue()
+                self.decode_slots = asyncio.Semaphore(self.max_in_flight)
                 await asyncio.gather(
                     self.image_producer(),
-                    self.image_consumer()
+                    self.image_consumer(),
+                    self.result_consumer()
                 )
             except Exception as e:
                 logging.error(f"Общая ошибка главного цикла: {e}")
                 self.status = DatamatrixDecoderStatus.GENERAL_FAILURE
-                self.notify()
                 self.set_no_image_available_picture()
                 await asyncio.sleep(2)
@@ -1,30 +1,117 @@
+import base64
+import binascii
 import logging
 import os
+import queue
 import sqlite3
 import datetime
-from typing import List
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterable, List, Set
+
+from backend.src.CodeIndex import CodeIndex
+from backend.src.MarkingCode import MarkingCode
+from backend.src.metrics import DATABASE_SECONDS
+
+# SQLite before 3.32 allows at most 999 parameters per statement
+MAX_QUERY_PARAMETERS = 900
+
+# WAL lets readers work alongside the writer and makes a commit a single sequential append. With synchronous=NORMAL
+# a power loss may lose the last commits but never corrupts the database.
+STORAGE_PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    # 64 MiB of page cache (negative values are in KiB)
+    "PRAGMA cache_size = -65536",
+    "PRAGMA mmap_size = 268435456",
+    "PRAGMA temp_store = MEMORY",
+)
+
+# INSERT ... RETURNING appeared in SQLite 3.35
+SUPPORTS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+# PRAGMA user_version of the current schema: 1 - codes are stored as raw bytes instead of base64 text
+SCHEMA_VERSION = 1
 
 
 class DatabaseManager:
-    def __init__(self, db_path: str = 'codes_database.db'):
+    """Codes storage shared by the decode pipelines and the web API.
+
+    All writes go through a single connection serialized by a lock. Reads take a read-only connection from a pool,
+    so in WAL mode they never wait for the writer and any thread can query the database.
+    """
+
+    def __init__(self, db_path: str = 'codes_database.db', use_index: bool = True, tuned_storage: bool = True,
+                 readers: int = 4):
         """Initialize the database manager with the specified database path."""
         os.makedirs(os.path.join('results', 'database'), exist_ok=True)
         self.db_path = os.path.join('results', 'database', db_path)
+        # the writer connection, used only while holding the write lock
         self.conn = None
         self.cursor = None
+        self._write_lock = threading.RLock()
+        # idle reader connections, more are opened on demand and closed when the pool is full
+        self._readers = queue.Queue(maxsize=readers)
+        # in-memory membership indexes of the code tables, so that most lookups never touch the disk
+        self._indexes = {}
+        self._index_lock = threading.Lock()
+        # codes saved while the index of a table is being built, by table. Present while a build runs.
+        self._index_backlog: Dict[str, List[MarkingCode]] = {}
+        self._closing = threading.Event()
+        self.tuned_storage = tuned_storage
         self._initialize_database()
+        if use_index:
+            # lookups go to the database until the indexes are built
+            for table in ('individual_codes', 'group_codes'):
+                self._rebuild_index(table)
+
+    def _rebuild_index(self, table: str) -> None:
+        """Build the membership index of a table in a background thread, the current one serves until it is done."""
+        with self._index_lock:
+            if table in self._index_backlog:
+                return
+            self._index_backlog[table] = []
+        threading.Thread(target=self._load_index, args=(table,), daemon=True, name=f"index_{table}").start()
+
+    def _load_index(self, table: str, min_capacity: int = 1_000_000):
+        """Build the membership index of a table with room for two more years at the pace of the last one, and for
+        the table to double at least, so that it is rarely rebuilt."""
+        try:
+            with self._reader() as conn:
+                count, last_year = conn.execute(
+                    f"SELECT COUNT(*), COALESCE(SUM(created_at >= datetime('now', '-1 year')), 0) FROM {table}"
+                ).fetchone()
+                index = CodeIndex(capacity=max(min_capacity, 2 * count, count + 2 * last_year))
+                for (code,) in conn.execute(f"SELECT code FROM {table}"):
+                    if self._closing.is_set():
+                        return
+                    index.bloom.add(code)
+            with self._index_lock:
+                # saved after the build started, they may be missing from what it has read
+                for code in self._index_backlog.pop(table, ()):
+                    index.add(code)
+                self._indexes[table] = index
+            logging.info(f"Loaded {count} codes of {table} into the in-memory index")
+        except sqlite3.Error as e:
+            logging.error(f"Error loading index of {table}, falling back to database lookups: {e}")
+            with self._index_lock:
+                self._index_backlog.pop(table, None)
+                self._indexes.pop(table, None)
 
     def _initialize_database(self):
         """Create the database and tables if they don't exist."""
         try:
-            self.conn = sqlite3.connect(self.db_path)
+            self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
             self.cursor = self.conn.cursor()
-            
+            if self.tuned_storage:
+                for pragma in STORAGE_PRAGMAS:
+                    self.cursor.execute(pragma)
+
             # Create tables for individual codes, group codes, and their relationships
             self.cursor.execute('''
                 CREATE TABLE IF NOT EXISTS individual_codes (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    code TEXT UNIQUE NOT NULL,
+                    code BLOB UNIQUE NOT NULL,
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                 )
             ''')
@@ -32,7 +119,7 @@ class DatabaseManager:
             self.cursor.execute('''
                 CREATE TABLE IF NOT EXISTS group_codes (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    code TEXT UNIQUE NOT NULL,
+                    code BLOB UNIQUE NOT NULL,
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                 )
             ''')
@@ -57,6 +144,7 @@ class DatabaseManager:
             ''')
 
             self.conn.commit()
+            self._migrate()
             logging.info("Database initialized successfully")
         except sqlite3.Error as e:
             logging.error(f"Database initialization error: {e}")
@@ -64,69 +152,140 @@ class DatabaseManager:
                 self.conn.close()
             raise
 
+    def _migrate(self):
+        """Bring a database created by an older version to SCHEMA_VERSION."""
+        version = self.cursor.execute("PRAGMA user_version").fetchone()[0]
+        if version >= SCHEMA_VERSION:
+            return
+        self.conn.execute("BEGIN IMMEDIATE")
+        if version < 1:
+            # codes used to be stored as base64 text, columns declared TEXT keep BLOB values as they are
+            for table in ('individual_codes', 'group_codes'):
+                rows = self.cursor.execute(f"SELECT id, code FROM {table} WHERE typeof(code) = 'text'").fetchall()
+                converted = []
+                for row_id, code in rows:
+                    try:
+                        converted.append((base64.b64decode(code, validate=True), row_id))
+                    except (binascii.Error, ValueError):
+                        logging.error(f"Code {code} of {table} is not base64, left as is")
+                self.cursor.executemany(f"UPDATE {table} SET code = ? WHERE id = ?", converted)
+                if converted:
+                    logging.info(f"Converted {len(converted)} codes of {table} from base64 to raw bytes")
+        self.cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        self.conn.commit()
+
     def close(self):
-        """Close the database connection."""
-        if self.conn:
-            self.conn.close()
-            self.conn = None
-            self.cursor = None
+        """Close the database connections."""
+        self._closing.set()
+        while not self._readers.empty():
+            self._readers.get_nowait().close()
+        with self._write_lock:
+            if self.conn:
+                self.conn.close()
+                self.conn = None
+                self.cursor = None
 
-    def is_individual_code_exists(self, code: str) -> bool:
-        """Check if an individual code already exists in the database."""
+    def _connect_reader(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True, check_same_thread=False)
+        if self.tuned_storage:
+            for pragma in STORAGE_PRAGMAS[2:]:
+                conn.execute(pragma)
+        return conn
+
+    @contextmanager
+    def _reader(self):
+        """A read-only connection for the calling thread, returned to the pool afterwards"""
         try:
-            self.cursor.execute("SELECT 1 FROM individual_codes WHERE code = ?", (code,))
-            return self.cursor.fetchone() is not None
-        except sqlite3.Error as e:
-            logging.error(f"Error checking individual code: {e}")
-            return False
+            conn = self._readers.get_nowait()
+        except queue.Empty:
+            conn = self._connect_reader()
+        try:
+            yield conn
+        finally:
+            try:
+                self._readers.put_nowait(conn)
+            except queue.Full:
+                conn.close()
 
-    def is_group_code_exists(self, code: str) -> bool:
+    def is_individual_code_exists(self, code: MarkingCode) -> bool:
+        """Check if an individual code already exists in the database."""
+        return bool(self.existing_individual_codes([code]))
+
+    def is_group_code_exists(self, code: MarkingCode) -> bool:
         """Check if a group code already exists in the database."""
+        return bool(self.existing_group_codes([code]))
+
+    def existing_individual_codes(self, codes: Iterable[MarkingCode]) -> Set[MarkingCode]:
+        """Return those of the given individual codes which already exist in the database."""
+        return self._existing_codes('individual_codes', codes)
+
+    def existing_group_codes(self, codes: Iterable[MarkingCode]) -> Set[MarkingCode]:
+        """Return those of the given group codes which already exist in the database."""
+        return self._existing_codes('group_codes', codes)
+
+    def _existing_codes(self, table: str, codes: Iterable[MarkingCode]) -> Set[MarkingCode]:
+        """Look the codes up in the in-memory index, confirming its possible hits with a single
+        IN (...) query per MAX_QUERY_PARAMETERS codes."""
+        with DATABASE_SECONDS.time(operation=f'lookup_{table}'):
+            return self._lookup_codes(table, codes)
+
+    def _lookup_codes(self, table: str, codes: Iterable[MarkingCode]) -> Set[MarkingCode]:
+        index = self._indexes.get(table)
+        if index:
+            with self._index_lock:
+                existing, possible = index.lookup(set(codes))
+            confirmed = self._query_existing_codes(table, possible)
+            with self._index_lock:
+                for code in confirmed:
+                    index.remember(code)
+            return existing | confirmed
+        return self._query_existing_codes(table, codes)
+
+    def _query_existing_codes(self, table: str, codes: Iterable[MarkingCode]) -> Set[MarkingCode]:
+        codes = {code.data: code for code in codes}
+        data = list(codes)
+        existing = set()
         try:
-            self.cursor.execute("SELECT 1 FROM group_codes WHERE code = ?", (code,))
-            return self.cursor.fetchone() is not None
+            with self._reader() as conn:
+                for start in range(0, len(data), MAX_QUERY_PARAMETERS):
+                    chunk = data[start:start + MAX_QUERY_PARAMETERS]
+                    placeholders = ','.join('?' * len(chunk))
+                    rows = conn.execute(f"SELECT code FROM {table} WHERE code IN ({placeholders})", chunk)
+                    existing.update(codes[row[0]] for row in rows)
+            return existing
         except sqlite3.Error as e:
-            logging.error(f"Error checking group code: {e}")
-            return False
+            logging.error(f"Error checking codes in {table}: {e}")
+            return set()
 
-    def save_codes(self, individual_codes: List[str], group_code: str) -> int:
+    def save_codes(self, individual_codes: List[MarkingCode], group_code: MarkingCode) -> int:
         """Save individual codes and group code to the database with their relationship."""
-        try:
-            # Begin transaction
-            self.conn.execute("BEGIN TRANSACTION")
-            # Insert group code
-            self.cursor.execute("INSERT INTO group_codes (code) VALUES (?)", (group_code,))
-            group_code_id = self.cursor.lastrowid
-
-            # Insert individual codes and create relationships
-            for code in individual_codes:
-                self.cursor.execute("INSERT INTO individual_codes (code) VALUES (?)", (code,))
-                individual_code_id = self.cursor.lastrowid
-
-                # Create relationship
-                self.cursor.execute(
-                    "INSERT INTO code_relationships (group_code_id, individual_code_id) VALUES (?, ?)",
-                    (group_code_id, individual_code_id)
-                )
+        # waiting for the write lock is part of the cost
+        with DATABASE_SECONDS.time(operation='save_codes'), self._write_lock:
+            return self._save_codes(individual_codes, group_code)
 
-            # Get the current date
-            current_date = datetime.date.today()
+    def _save_codes(self, individual_codes: List[MarkingCode], group_code: MarkingCode) -> int:
+        try:
+            # Take the write lock up front, so the daily sequence can not be bumped by another writer meanwhile
+            self.conn.execute("BEGIN IMMEDIATE")
+            group_code_id = self._insert_codes('group_codes', [group_code])[0]
+            individual_code_ids = self._insert_codes('individual_codes', individual_codes)
+            self.cursor.executemany(
+                "INSERT INTO code_relationships (group_code_id, individual_code_id) VALUES (?, ?)",
+                [(group_code_id, individual_code_id) for individual_code_id in individual_code_ids]
+            )
 
-            # Check if the current date exists in the daily_sequence table
+            # Start the sequence of the current date at 1 or increment it, in one statement
+            current_date = datetime.date.today().isoformat()
+            self.cursor.execute(
+                "INSERT INTO daily_sequence (date, sequence) VALUES (?, 1) "
+                "ON CONFLICT (date) DO UPDATE SET sequence = sequence + 1",
+                (current_date,)
+            )
             self.cursor.execute("SELECT sequence FROM daily_sequence WHERE date = ?", (current_date,))
-            result = self.cursor.fetchone()
-
-            if result is None:
-                # If the current date does not exist in the daily_sequence table, insert a new record with the current date and sequence number 1
-                self.cursor.execute("INSERT INTO daily_sequence (date, sequence) VALUES (?, 1)", (current_date,))
-                sequence_number = 1
-            else:
-                # If the current date exists in the daily_sequence table, increment the sequence number by 1
-                sequence_number = result[0] + 1
-                self.cursor.execute("UPDATE daily_sequence SET sequence = ? WHERE date = ?", (sequence_number, current_date))
-
-            # Commit transaction
+            sequence_number = self.cursor.fetchone()[0]
+
             self.conn.commit()
+            self._index_saved_codes(individual_codes, group_code)
             logging.info(f"Saved {len(individual_codes)} individual codes and 1 group code to database")
             return sequence_number
         except sqlite3.Error as e:
@@ -134,14 +293,64 @@ class DatabaseManager:
             self.conn.rollback()
             return -1
 
-    def check_duplicate_codes(self, individual_codes: List[str]) -> List[str]:
-        """Check if any individual codes already exist in the database and return the duplicates."""
-        duplicates = []
+    def _insert_codes(self, table: str, codes: List[MarkingCode]) -> List[int]:
+        """Insert codes with as few statements as possible and return their ids."""
+        if not SUPPORTS_RETURNING:
+            ids = []
+            for code in codes:
+                self.cursor.execute(f"INSERT INTO {table} (code) VALUES (?)", (code.data,))
+                ids.append(self.cursor.lastrowid)
+            return ids
+        ids = []
+        for start in range(0, len(codes), MAX_QUERY_PARAMETERS):
+            chunk = [code.data for code in codes[start:start + MAX_QUERY_PARAMETERS]]
+            placeholders = ','.join(['(?)'] * len(chunk))
+            self.cursor.execute(f"INSERT INTO {table} (code) VALUES {placeholders} RETURNING id", chunk)
+            ids.extend(row[0] for row in self.cursor.fetchall())
+        return ids
+
+    def _index_saved_codes(self, individual_codes: List[MarkingCode], group_code: MarkingCode):
+        for table, codes in (('individual_codes', individual_codes), ('group_codes', [group_code])):
+            with self._index_lock:
+                backlog = self._index_backlog.get(table)
+                if backlog is not None:
+                    backlog.extend(codes)
+                index = self._indexes.get(table)
+                if index is None:
+                    continue
+                for code in codes:
+                    index.add(code)
+            if index.bloom.is_overfilled:
+                # false positive rate grows past the designed one, rebuild with more room
+                self._rebuild_index(table)
+
+    def get_history(self, limit: int = 50, offset: int = 0) -> List[dict]:
+        """Return the last saved group codes, newest first, with their individual codes."""
         try:
-            for code in individual_codes:
-                if self.is_individual_code_exists(code):
-                    duplicates.append(code)
-            return duplicates
+            with self._reader() as conn:
+                groups = conn.execute(
+                    "SELECT id, code, created_at FROM group_codes ORDER BY id DESC LIMIT ? OFFSET ?",
+                    (limit, offset)
+                ).fetchall()
+                if not groups:
+                    return []
+                placeholders = ','.join('?' * len(groups))
+                rows = conn.execute(
+                    "SELECT r.group_code_id, i.code FROM code_relationships r "
+                    "JOIN individual_codes i ON i.id = r.individual_code_id "
+                    f"WHERE r.group_code_id IN ({placeholders}) ORDER BY i.id",
+                    [group[0] for group in groups]
+                ).fetchall()
         except sqlite3.Error as e:
-            logging.error(f"Error checking duplicate codes: {e}")
+            logging.error(f"Error reading history: {e}")
             return []
+        individual_codes = {group[0]: [] for group in groups}
+        for group_code_id, code in rows:
+            individual_codes[group_code_id].append(MarkingCode(code))
+        return [{"group_code": MarkingCode(code), "created_at": created_at, "individual_codes": individual_codes[group_code_id]}
+                for group_code_id, code, created_at in groups]
+
+    def check_duplicate_codes(self, individual_codes: List[MarkingCode]) -> List[MarkingCode]:
+        """Check if any individual codes already exist in the database and return the duplicates."""
+        existing = self.existing_individual_codes(individual_codes)
+        return [code for code in individual_codes if code in existing]
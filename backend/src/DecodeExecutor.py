@@ -0,0 +1,98 @@
+import asyncio
+import logging
+import os
+from concurrent.futures import BrokenExecutor, Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+
+from backend.src.metrics import DECODE_EXECUTOR_RESTARTS
+
+DECODE_EXECUTOR_KINDS = ('process', 'thread', 'inline')
+
+
+class DecodeExecutor:
+    """Runs CPU-heavy decode jobs outside of the asyncio event loop."""
+    kind: str = 'inline'
+
+    def __init__(self, workers: int = 1):
+        self.workers = max(1, workers)
+
+    async def run(self, func, *args, **kwargs):
+        raise NotImplementedError
+
+    def shutdown(self):
+        pass
+
+
+class InlineDecodeExecutor(DecodeExecutor):
+    """Decodes right inside the event loop. Blocks the loop, use for debugging only."""
+    kind = 'inline'
+
+    def __init__(self, workers: int = 1):
+        super().__init__(1)
+
+    async def run(self, func, *args, **kwargs):
+        return func(*args, **kwargs)
+
+
+class PoolDecodeExecutor(DecodeExecutor):
+    kind = 'pool'
+
+    def __init__(self, workers: int = 1):
+        super().__init__(workers)
+        self._pool = self._create_pool()
+
+    def _create_pool(self) -> Executor:
+        raise NotImplementedError
+
+    async def run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        pool = self._pool
+        try:
+            return await loop.run_in_executor(pool, partial(func, *args, **kwargs))
+        except BrokenExecutor:
+            self._restart(pool)
+            raise
+
+    def _restart(self, broken: Executor):
+        """Replaces a pool whose worker died, e.g. crashed in libdmtx or was killed for memory"""
+        # all jobs in flight fail together, the pool is rebuilt once
+        if self._pool is not broken:
+            return
+        logging.error(f"Обработчик декодирования `{self.kind}` аварийно завершился, пул обработчиков перезапущен")
+        DECODE_EXECUTOR_RESTARTS.inc(kind=self.kind)
+        broken.shutdown(wait=False, cancel_futures=True)
+        self._pool = self._create_pool()
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+
+class ThreadPoolDecodeExecutor(PoolDecodeExecutor):
+    """Decodes in a thread pool. libdmtx calls release the GIL, so threads scale across cores too."""
+    kind = 'thread'
+
+    def _create_pool(self) -> Executor:
+        return ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='decode')
+
+
+class ProcessPoolDecodeExecutor(PoolDecodeExecutor):
+    """Decodes in a pool of worker processes. Jobs and their arguments must be picklable."""
+    kind = 'process'
+
+    def _create_pool(self) -> Executor:
+        return ProcessPoolExecutor(max_workers=self.workers)
+
+
+def create_decode_executor(kind: str = 'process', workers: int | None = None) -> DecodeExecutor:
+    if workers is None or workers < 1:
+        workers = os.cpu_count() or 1
+    if kind == 'process':
+        executor = ProcessPoolDecodeExecutor(workers)
+    elif kind == 'thread':
+        executor = ThreadPoolDecodeExecutor(workers)
+    elif kind == 'inline':
+        executor = InlineDecodeExecutor()
+    else:
+        raise ValueError(f"Unknown decode executor kind [{kind}]: should be one of {DECODE_EXECUTOR_KINDS}")
+    logging.info(f"Декодирование выполняется в режиме `{executor.kind}`, обработчиков: {executor.workers}")
+    return executor
@@ -0,0 +1,109 @@
+import json
+import logging
+import math
+import os
+from collections import deque
+from typing import Dict
+
+# libdmtx drops a region when the strength of its starting edge is below `threshold * 7.65`
+EDGE_STRENGTH_PER_THRESHOLD = 7.65
+
+
+def _side_lengths(corners):
+    return [math.dist(corners[i], corners[(i + 1) % len(corners)]) for i in range(len(corners))]
+
+
+class DecodeTuner:
+    """Learns libdmtx decode properties (symbol size, edge min/max, edge threshold and shrink) from the geometry
+    of codes decoded on the last frames. Falls back to the default wide search after repeated misses.
+
+    Marking and aggregation codes differ in symbol size and print scale, so a tuner learns one kind of codes:
+    it is only given the codes of its kind and a frame without any of them is a miss.
+
+    Learned values are in camera frame pixels and are saved to disk, so they survive restarts.
+    """
+
+    def __init__(self, path: str = os.path.join('results', 'decoder_tuning.json'), window: int = 20,
+                 min_frames: int = 5, max_misses: int = 5, margin: float = 0.2, min_module_px: float = 4.0):
+        self.path = path
+        self.min_frames = min_frames
+        # frames in a row without any code of the kind before the learned values are dropped
+        self.max_misses = max_misses
+        # how much wider than the observed values the search is
+        self.margin = margin
+        # shrink the image only while a module stays at least this many pixels
+        self.min_module_px = min_module_px
+        # per frame observations: (min edge, max edge, size indexes, min edge strength, min module size)
+        self._frames = deque(maxlen=window)
+        self._misses = 0
+        self._params: Dict[str, int] = {}
+        self._load()
+
+    @property
+    def params(self) -> Dict[str, int]:
+        """Keyword arguments for `decode_with_regions`, empty while nothing is learned"""
+        return dict(self._params)
+
+    def observe(self, decoded_messages_with_regions) -> None:
+        if not decoded_messages_with_regions:
+            self._misses += 1
+            if self._misses == self.max_misses and self._params:
+                logging.info("Коды не найдены на нескольких кадрах подряд, параметры декодирования сброшены")
+                self._frames.clear()
+                self._update({})
+            return
+        self._misses = 0
+        sides = [_side_lengths(msg.corners) for msg in decoded_messages_with_regions]
+        self._frames.append((
+            min(min(s) for s in sides),
+            max(max(s) for s in sides),
+            {msg.size_idx for msg in decoded_messages_with_regions},
+            min(msg.edge_strength for msg in decoded_messages_with_regions),
+            min((min(s) / msg.modules for s, msg in zip(sides, decoded_messages_with_regions) if msg.modules),
+                default=0),
+        ))
+        if len(self._frames) >= self.min_frames:
+            self._update(self._learn())
+
+    def _learn(self) -> Dict[str, int]:
+        min_edge = min(frame[0] for frame in self._frames)
+        max_edge = max(frame[1] for frame in self._frames)
+        size_idxs = set().union(*(frame[2] for frame in self._frames))
+        edge_strength = min(frame[3] for frame in self._frames)
+        module_px = min(frame[4] for frame in self._frames)
+        params = {
+            'min_edge': max(int(min_edge * (1 - self.margin)), 1),
+            'max_edge': int(math.ceil(max_edge * (1 + self.margin))),
+            'threshold': min(max(int(edge_strength * (1 - self.margin) / EDGE_STRENGTH_PER_THRESHOLD), 1), 100),
+            'shrink': max(int(module_px // self.min_module_px), 1),
+        }
+        if len(size_idxs) == 1:
+            params['shape'] = size_idxs.pop()
+        return params
+
+    def _update(self, params: Dict[str, int]) -> None:
+        if params == self._params:
+            return
+        logging.info(f"Параметры декодирования: {params if params else 'по умолчанию'}")
+        self._params = params
+        self._save()
+
+    def _load(self):
+        try:
+            with open(self.path) as file:
+                self._params = {k: int(v) for k, v in json.load(file).items()}
+            logging.info(f"Загружены параметры декодирования {self._params} из {self.path}")
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, AttributeError) as e:
+            logging.error(f"Невозможно загрузить параметры декодирования из {self.path}: {e}")
+
+    def _save(self):
+        try:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, 'w') as file:
+                json.dump(self._params, file)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logging.error(f"Невозможно сохранить параметры декодирования в {self.path}: {e}")
@@ -1,43 +1,207 @@
+import asyncio
+import json
 import logging
 import os
+import queue
+import threading
+import time
+from typing import List
 
+from backend.src.Codes2TXT import generate_csv
+from backend.src.Codes2XML import generate_xml
 from backend.src.status import FileSaverStatus
 from backend.src.StatusObservable import StatusObservable
+from backend.src.metrics import FILE_WRITE_ERRORS, FILE_WRITE_SECONDS, FILES_PENDING
 
 
 class FileSaver(StatusObservable):
-    def __init__(self):
+    """Saves result files of the aggregated boxes.
+
+    Boxes are written behind: `save_aggregation` only appends the box to a journal and queues it, XML/CSV files are
+    rendered and written by a background thread. Every file is fsynced before it is renamed into place, the renames
+    and the journal are synced once per batch. Boxes still in the journal when the application stops are written
+    again on the next start.
+    """
+
+    def __init__(self, results_dir: str = 'results', queue_size: int = 64, batch_size: int = 16,
+                 max_retries: int = 5, retry_delay: float = 0.5, line: str = 'default'):
         super().__init__()
+        # packing line the files belong to, labels the metrics
+        self.line = line
         self.status = FileSaverStatus.INIT
-        self.notify()
-        self.results_dir = 'results'
+        self.results_dir = results_dir
+        self.journal_path = os.path.join(results_dir, 'journal.jsonl')
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        # a full queue blocks the aggregation until the disk catches up
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._journal = None
+        self._journal_lock = threading.Lock()
+        # journaled boxes whose files are not written yet
+        self._pending = 0
+        self._failed = 0
+        self._writer = None
+        FILES_PENDING.set_function(lambda: self._pending, line=line)
         try:
             os.makedirs(self.results_dir, exist_ok=True)
             logging.info(f"Внутренняя директория для сохранения файлов: {self.results_dir}")
+            pending = self._load_journal()
+            self._pending = len(pending)
+            self._journal = open(self.journal_path, 'a')
             self.status = FileSaverStatus.READY
-            self.notify()
         except Exception as e:
             logging.error(f"Невозможно создать внутреннюю директорию для сохранения файлов {self.results_dir}: {e}")
             self.status = FileSaverStatus.FOLDER_CREATION_FAILED
-            self.notify()
+            return
+        self._writer = threading.Thread(target=self._write_loop, daemon=True, name=f"{self._name}_writer")
+        self._writer.start()
+        for job in pending:
+            self._queue.put(job)
 
-    def save_file(self, file_path: str, content: str, subdir: str | None = None) -> int:
-        if self.status != FileSaverStatus.READY:
+    async def save_aggregation(self, filename: str, codes: List[str], group_code: str) -> int:
+        """Journals a box and queues its `filename`.xml and `filename`.csv for writing.
+
+        Returns once the journal entry is on disk. Waits while the queue is full, without blocking the event loop.
+        """
+        if self._writer is None:
             logging.error("Хранитель файлов не готов")
             return -1
-        logging.info(f"Сохраняю файл {file_path}...")
-        self.status = FileSaverStatus.SAVING
+        job = {"filename": filename, "codes": list(codes), "group_code": group_code}
         try:
-            if subdir:
-                os.makedirs(os.path.join(self.results_dir, subdir), exist_ok=True)
-                file_path = os.path.join(subdir, file_path)
-            with open(os.path.join(self.results_dir, file_path), 'w') as file:
-                file.write(content)
-                logging.info(f"Файл {file_path} успешно сохранён")
-                self.status = FileSaverStatus.READY
+            await asyncio.to_thread(self._journal_job, job)
         except Exception as e:
-            logging.error(f"Ошибка сохранения файла: {e}")
+            logging.error(f"Ошибка записи в журнал {self.journal_path}: {e}")
             self.status = FileSaverStatus.SAVING_FAILED
             return -1
-        self.notify()
+        if self._queue.full():
+            logging.warning("Очередь записи файлов заполнена, жду запись на диск")
+        await asyncio.to_thread(self._queue.put, job)
         return 0
+
+    def _journal_job(self, job: dict) -> None:
+        with self._journal_lock:
+            self._journal.write(json.dumps({"op": "save", **job}) + "\n")
+            self._journal.flush()
+            os.fsync(self._journal.fileno())
+            self._pending += 1
+
+    def close(self, timeout: float = 10.0) -> None:
+        """Waits for the queued files to be written and stops the writer"""
+        if self._writer is None:
+            return
+        self._queue.put(None)
+        self._writer.join(timeout)
+        if self._writer.is_alive():
+            logging.error(f"Не все файлы записаны за {timeout} с, они будут записаны при следующем запуске")
+        self._writer = None
+        with self._journal_lock:
+            self._journal.close()
+
+    def get_stats(self) -> dict:
+        return {"status": str(self.status), "pending": self._pending, "failed": self._failed}
+
+    def _load_journal(self) -> List[dict]:
+        """Returns the journaled boxes whose files were not written and leaves only them in the journal"""
+        pending = {}
+        try:
+            with open(self.journal_path) as file:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # the last line may be cut by a crash
+                        continue
+                    filename = entry.pop("filename")
+                    if entry.pop("op") == "save":
+                        pending[filename] = {"filename": filename, **entry}
+                    else:
+                        pending.pop(filename, None)
+        except FileNotFoundError:
+            return []
+        tmp_path = f"{self.journal_path}.tmp"
+        with open(tmp_path, 'w') as file:
+            for job in pending.values():
+                file.write(json.dumps({"op": "save", **job}) + "\n")
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, self.journal_path)
+        if pending:
+            logging.warning(f"В журнале {len(pending)} незаписанных коробок, записываю их снова")
+        return list(pending.values())
+
+    def _write_loop(self):
+        stop = False
+        while not stop:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            if None in batch:
+                stop = True
+                batch = [job for job in batch if job is not None]
+            if not batch:
+                continue
+            self.status = FileSaverStatus.SAVING
+            written = [job for job in batch if self._write_job(job)]
+            self._commit(written)
+            if len(written) < len(batch):
+                self._failed += len(batch) - len(written)
+                self.status = FileSaverStatus.SAVING_FAILED
+            elif self._queue.empty():
+                self.status = FileSaverStatus.READY
+
+    def _write_job(self, job: dict) -> bool:
+        filename = job["filename"]
+        for attempt in range(1, self.max_retries + 1):
+            try:
+                with FILE_WRITE_SECONDS.time(line=self.line):
+                    logging.info(f"Создаю и сохраняю XML файл {filename}.xml")
+                    self._write_file(f"{filename}.xml", generate_xml(job["codes"], job["group_code"]), 'xml')
+                    logging.info(f"Создаю и сохраняю CSV файл {filename}.csv")
+                    self._write_file(f"{filename}.csv", generate_csv(job["codes"], job["group_code"]), 'csv')
+                return True
+            except OSError as e:
+                FILE_WRITE_ERRORS.inc(line=self.line)
+                logging.error(f"Ошибка сохранения файлов {filename} (попытка {attempt} из {self.max_retries}): {e}")
+                time.sleep(self.retry_delay * attempt)
+        return False
+
+    def _write_file(self, file_path: str, content: str, subdir: str | None = None):
+        directory = self.results_dir
+        if subdir:
+            directory = os.path.join(self.results_dir, subdir)
+            os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, file_path)
+        # readers never see a half written file
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w') as file:
+            file.write(content)
+            # a synced rename of unsynced data may leave an empty file after a power loss
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, path)
+
+    def _commit(self, jobs: List[dict]):
+        """Makes the renames of a batch durable with one fsync per directory and marks its boxes written"""
+        if not jobs:
+            return
+        try:
+            for subdir in ('xml', 'csv'):
+                fd = os.open(os.path.join(self.results_dir, subdir), os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+            with self._journal_lock:
+                for job in jobs:
+                    self._journal.write(json.dumps({"op": "done", "filename": job["filename"]}) + "\n")
+                self._pending -= len(jobs)
+                if self._pending == 0:
+                    # nothing is pending, start the journal over
+                    self._journal.truncate(0)
+                self._journal.flush()
+                os.fsync(self._journal.fileno())
+        except OSError as e:
+            logging.error(f"Ошибка записи в журнал {self.journal_path}: {e}")
+        for job in jobs:
+            logging.info(f"Файлы {job['filename']} успешно сохранены")
@@ -0,0 +1,78 @@
+import asyncio
+import time
+from collections import deque
+from enum import Enum
+
+
+class FrameBufferPolicy(Enum):
+    # drop the oldest frame when the buffer is full
+    DROP_OLDEST = "drop_oldest"
+    # keep only the latest frame, whatever the capacity is
+    LATEST_ONLY = "latest_only"
+    # make the producer wait for free space
+    BLOCK = "block"
+
+    def __str__(self):
+        return self.value
+
+
+class FrameBuffer:
+    """Bounded buffer of fetched frames between the producer and the consumer of `DataMatrixDecoder`.
+    Counts dropped frames and measures how old frames are when they are taken for decoding."""
+
+    def __init__(self, capacity: int = 2, policy: FrameBufferPolicy = FrameBufferPolicy.DROP_OLDEST,
+                 age_window: int = 100):
+        if capacity < 1:
+            raise ValueError(f"Invalid frame buffer capacity [{capacity}]")
+        self.capacity = 1 if policy == FrameBufferPolicy.LATEST_ONLY else capacity
+        self.policy = policy
+        self._frames = deque()
+        self._not_empty = asyncio.Event()
+        self._not_full = asyncio.Event()
+        self.received = 0
+        self.dropped = 0
+        # ages of the last taken frames, milliseconds
+        self._ages = deque(maxlen=age_window)
+
+    def __len__(self):
+        return len(self._frames)
+
+    async def put(self, item) -> None:
+        if self.policy == FrameBufferPolicy.BLOCK:
+            while len(self._frames) >= self.capacity:
+                self._not_full.clear()
+                await self._not_full.wait()
+        else:
+            while len(self._frames) >= self.capacity:
+                self._frames.popleft()
+                self.dropped += 1
+        self._frames.append((time.monotonic(), item))
+        self.received += 1
+        self._not_empty.set()
+
+    async def get(self):
+        while not self._frames:
+            self._not_empty.clear()
+            await self._not_empty.wait()
+        fetched_at, item = self._frames.popleft()
+        self._not_full.set()
+        self._ages.append((time.monotonic() - fetched_at) * 1000)
+        return item
+
+    def clear(self) -> None:
+        self.dropped += len(self._frames)
+        self._frames.clear()
+        self._not_full.set()
+
+    def get_stats(self) -> dict:
+        ages = self._ages
+        return {
+            "policy": str(self.policy),
+            "capacity": self.capacity,
+            "depth": len(self._frames),
+            "received": self.received,
+            "dropped": self.dropped,
+            "age_ms_last": round(ages[-1], 1) if ages else None,
+            "age_ms_avg": round(sum(ages) / len(ages), 1) if ages else None,
+            "age_ms_max": round(max(ages), 1) if ages else None,
+        }
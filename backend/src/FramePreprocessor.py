@@ -0,0 +1,117 @@
+import logging
+import time
+from typing import Dict
+
+import cv2
+import numpy
+
+from .pylibdmtx.pylibdmtx import Decoded, DecodedRegion, Rect
+
+# JPEG decoding mode -> (cv2.imread flag, how many times the decoded frame is smaller than the camera frame)
+IMREAD_MODES = {
+    'unchanged': (cv2.IMREAD_UNCHANGED, 1),
+    'gray': (cv2.IMREAD_GRAYSCALE, 1),
+    'reduced2': (cv2.IMREAD_REDUCED_GRAYSCALE_2, 2),
+    'reduced4': (cv2.IMREAD_REDUCED_GRAYSCALE_4, 4),
+}
+
+
+def scale_region(decoded_region: DecodedRegion, factor: float) -> DecodedRegion:
+    decoded = decoded_region.decoded
+    return decoded_region._replace(
+        decoded=Decoded(decoded.data, Rect(*(int(v * factor) for v in decoded.rect))),
+        corners=tuple((int(x * factor), int(y * factor)) for x, y in decoded_region.corners)
+    )
+
+
+class FramePreprocessor:
+    """Prepares camera frames for libdmtx: grayscale or reduced JPEG decoding, contrast enhancement,
+    binarization and downscaling to the smallest size at which codes are still readable.
+
+    Instances are sent to the decode workers, so they hold only plain settings.
+    """
+
+    def __init__(self, imread_mode: str = 'unchanged', clahe: bool = False, adaptive_threshold: bool = False,
+                 module_size: float | None = None, min_module_px: float = 4.0):
+        if imread_mode not in IMREAD_MODES:
+            raise ValueError(f"Unknown imread mode [{imread_mode}]: should be one of {list(IMREAD_MODES)}")
+        self.imread_mode = imread_mode
+        self.imread_flag, self.reduction = IMREAD_MODES[imread_mode]
+        self.clahe = clahe
+        self.adaptive_threshold = adaptive_threshold
+        # expected size of a code module in camera frame pixels
+        self.module_size = module_size
+        self.min_module_px = min_module_px
+
+    @property
+    def decode_scale(self) -> float:
+        """Scale applied to the decoded JPEG, so that a module is still at least `min_module_px` pixels"""
+        if not self.module_size:
+            return 1.0
+        return min(1.0, self.min_module_px * self.reduction / self.module_size)
+
+    def decode_jpeg(self, buffer):
+        image_array = numpy.asarray(bytearray(buffer), dtype=numpy.uint8)
+        return cv2.imdecode(image_array, self.imread_flag)
+
+    def convert_frame(self, frame):
+        """Brings a BGR frame from a video stream to the same form `decode_jpeg` would have decoded it in"""
+        if self.imread_flag == cv2.IMREAD_UNCHANGED:
+            return frame
+        if frame.ndim == 3:
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        if self.reduction > 1:
+            frame = cv2.resize(frame, None, fx=1 / self.reduction, fy=1 / self.reduction,
+                               interpolation=cv2.INTER_AREA)
+        return frame
+
+    def prepare(self, image, timings: Dict[str, float]):
+        """Returns the image to be decoded and how many camera frame pixels are in one of its pixels"""
+        started = time.perf_counter()
+        if (self.clahe or self.adaptive_threshold) and image.ndim == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        scale = self.decode_scale
+        if scale < 1.0:
+            image = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        timings['resize'] = (time.perf_counter() - started) * 1000
+        if self.clahe:
+            started = time.perf_counter()
+            image = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8)).apply(image)
+            timings['clahe'] = (time.perf_counter() - started) * 1000
+        if self.adaptive_threshold:
+            started = time.perf_counter()
+            # neighbourhood of a couple of modules, must be odd
+            block_size = 2 * int(self.min_module_px if self.module_size else 15) + 1
+            image = cv2.adaptiveThreshold(image, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY,
+                                          max(block_size, 3), 2)
+            timings['threshold'] = (time.perf_counter() - started) * 1000
+        return image, self.reduction / scale
+
+
+class StageTimings:
+    """Accumulates per stage timings of decoded frames and periodically logs averages and decodes per second"""
+
+    def __init__(self, report_every: int = 50):
+        self.report_every = report_every
+        self._reset()
+
+    def _reset(self):
+        self._totals: Dict[str, float] = {}
+        self._frames = 0
+        self._codes = 0
+        self._started = time.monotonic()
+
+    def add(self, timings: Dict[str, float], codes_count: int) -> None:
+        for stage, ms in timings.items():
+            self._totals[stage] = self._totals.get(stage, 0.0) + ms
+        self._frames += 1
+        self._codes += codes_count
+        if self._frames >= self.report_every:
+            logging.info(self.summary())
+            self._reset()
+
+    def summary(self) -> str:
+        elapsed = max(time.monotonic() - self._started, 1e-6)
+        stages = ', '.join(f"{stage}={total / self._frames:.1f}" for stage, total in self._totals.items())
+        return (f"Среднее время этапов, мс: {stages}. Кадров/с: {self._frames / elapsed:.2f}, "
+                f"кодов/с: {self._codes / elapsed:.2f}")
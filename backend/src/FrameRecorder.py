@@ -0,0 +1,110 @@
+import logging
+import os
+import queue
+import struct
+import threading
+import time
+from typing import BinaryIO, Iterator, Tuple
+
+import cv2
+
+# file header: format name and version
+MAGIC = b'DMXREC1\n'
+# frame header: epoch seconds when the frame was received, length of the JPEG following it
+FRAME_HEADER = struct.Struct('<dI')
+
+
+class FrameRecorder:
+    """Archives raw camera JPEGs with their timestamps to an append-only file, for `ReplayFrameSource`.
+
+    The file is `MAGIC` followed by frames: `FRAME_HEADER` and the JPEG bytes. Frames are written by a background
+    thread. When the disk falls behind, frames are dropped instead of slowing the pipeline down.
+    """
+
+    def __init__(self, path: str, queue_size: int = 32, jpeg_quality: int = 90):
+        self.path = path
+        # quality of the frames which come decoded, from a video stream
+        self.jpeg_quality = jpeg_quality
+        self.recorded = 0
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=queue_size)
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._file = open(path, 'ab')
+        if self._file.tell() == 0:
+            self._file.write(MAGIC)
+        self._writer = threading.Thread(target=self._write_loop, daemon=True, name='frame_recorder')
+        self._writer.start()
+        logging.info(f"Кадры записываются в {path}")
+
+    def record(self, jpeg: bytes, timestamp: float | None = None) -> None:
+        self._put((time.time() if timestamp is None else timestamp, jpeg))
+
+    def record_image(self, image, timestamp: float | None = None) -> None:
+        """Records a decoded frame, the writer thread encodes it to JPEG. The image must not be modified afterwards."""
+        self._put((time.time() if timestamp is None else timestamp, image))
+
+    def _put(self, item) -> None:
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self, timeout: float = 5.0) -> None:
+        if self._writer is None:
+            return
+        self._queue.put(None)
+        self._writer.join(timeout)
+        self._writer = None
+        self._file.close()
+        logging.info(f"Записано кадров в {self.path}: {self.recorded}, пропущено: {self.dropped}")
+
+    def _write_loop(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            timestamp, frame = item
+            try:
+                if not isinstance(frame, bytes):
+                    ok, buffer = cv2.imencode('.jpg', frame, [int(cv2.IMWRITE_JPEG_QUALITY), self.jpeg_quality])
+                    if not ok:
+                        raise cv2.error("JPEG encoding failed")
+                    frame = buffer.tobytes()
+                self._file.write(FRAME_HEADER.pack(timestamp, len(frame)) + frame)
+                self.recorded += 1
+            except (OSError, cv2.error) as e:
+                logging.error(f"Ошибка записи кадра в {self.path}: {e}")
+            if self._queue.empty():
+                self._file.flush()
+
+
+def read_recording(path: str) -> Iterator[Tuple[float, bytes]]:
+    """Iterates over (timestamp, JPEG bytes) of the frames recorded by `FrameRecorder`.
+
+    Raises:
+        ValueError: if the file is not a frame recording.
+    """
+    file = open(path, 'rb')
+    if file.read(len(MAGIC)) != MAGIC:
+        file.close()
+        raise ValueError(f"File [{path}] is not a frame recording")
+    return _read_frames(file, path)
+
+
+def _read_frames(file: BinaryIO, path: str) -> Iterator[Tuple[float, bytes]]:
+    with file:
+        while True:
+            header = file.read(FRAME_HEADER.size)
+            if not header:
+                return
+            if len(header) == FRAME_HEADER.size:
+                timestamp, length = FRAME_HEADER.unpack(header)
+                jpeg = file.read(length)
+                if len(jpeg) == length:
+                    yield timestamp, jpeg
+                    continue
+            # the recorder was stopped in the middle of a frame
+            logging.warning(f"Запись {path} обрывается на неполном кадре")
+            return
@@ -0,0 +1,229 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from typing import Tuple
+from urllib.parse import quote, urlsplit, urlunsplit
+
+import cv2
+import httpx
+
+from backend.src.FramePreprocessor import FramePreprocessor
+from backend.src.FrameRecorder import FrameRecorder, read_recording
+
+FRAME_SOURCE_KINDS = ('snapshot', 'stream', 'replay')
+
+
+class FrameUnavailableError(Exception):
+    """The camera did not deliver a frame"""
+
+
+def _with_credentials(url: str, credentials: Tuple[str, str] | None) -> str:
+    """`url` with the user name and password embedded, unless it already has them. FFmpeg answers both Basic and
+    Digest challenges of HTTP and RTSP cameras with the credentials of the URL."""
+    parts = urlsplit(url)
+    if credentials is None or not parts.hostname or parts.username is not None:
+        return url
+    username, password = credentials
+    return urlunsplit(parts._replace(netloc=f"{quote(username, safe='')}:{quote(password, safe='')}@{parts.netloc}"))
+
+
+class FrameSource:
+    """Source of camera frames for `DataMatrixDecoder`"""
+
+    def __init__(self, url: str, preprocessor: FramePreprocessor | None = None):
+        self.url = url
+        self.preprocessor = preprocessor if preprocessor else FramePreprocessor()
+        # time spent turning the last frame into an image, milliseconds
+        self.decode_ms = 0.0
+        # archives the frames as they come from the camera
+        self.recorder: FrameRecorder | None = None
+
+    async def open(self):
+        pass
+
+    async def close(self):
+        pass
+
+    async def read(self):
+        """Returns the next frame as an image prepared by `FramePreprocessor.decode_jpeg`.
+
+        Raises:
+            FrameUnavailableError: if the camera can not be reached.
+            cv2.error: if the frame can not be decoded.
+        """
+        raise NotImplementedError
+
+
+class SnapshotFrameSource(FrameSource):
+    """Requests every frame as a separate JPEG snapshot over HTTP"""
+
+    def __init__(self, url: str, preprocessor: FramePreprocessor | None = None, auth: httpx.Auth | None = None,
+                 timeout: float = 1.0):
+        super().__init__(url, preprocessor)
+        self.auth = auth
+        self.timeout = timeout
+        self.client: httpx.AsyncClient | None = None
+
+    async def open(self):
+        self.client = httpx.AsyncClient(auth=self.auth)
+
+    async def close(self):
+        if self.client:
+            await self.client.aclose()
+            self.client = None
+
+    async def read(self):
+        if self.client is None:
+            await self.open()
+        try:
+            response = await self.client.get(self.url, timeout=self.timeout)
+            response.raise_for_status()
+        except httpx.HTTPError as e:
+            raise FrameUnavailableError(str(e)) from e
+        if self.recorder:
+            self.recorder.record(response.content)
+        started = time.perf_counter()
+        image = self.preprocessor.decode_jpeg(response.content)
+        self.decode_ms = (time.perf_counter() - started) * 1000
+        if image is None:
+            raise cv2.error(f"Невозможно декодировать JPEG размером {len(response.content)} байт")
+        return image
+
+
+class StreamFrameSource(FrameSource):
+    """Keeps one MJPEG (multipart/x-mixed-replace) or RTSP stream open through OpenCV/FFmpeg and always hands
+    out the freshest frame. Frames arriving faster than they are read are skipped.
+
+    `credentials` are put into the URL opened by FFmpeg, credentials already in `url` take precedence."""
+
+    def __init__(self, url: str, preprocessor: FramePreprocessor | None = None, timeout: float = 1.0,
+                 reconnect_delay: float = 1.0, credentials: Tuple[str, str] | None = None):
+        super().__init__(url, preprocessor)
+        # `url` stays free of the password, it is logged
+        self._capture_url = _with_credentials(url, credentials)
+        self.timeout = timeout
+        self.reconnect_delay = reconnect_delay
+        self._frame = None
+        self._frame_seq = 0
+        self._read_seq = 0
+        self._frame_ready: asyncio.Event | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    async def open(self):
+        self._loop = asyncio.get_running_loop()
+        self._frame_ready = asyncio.Event()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._capture_loop, daemon=True, name=f"stream_{self.url}")
+        self._thread.start()
+
+    async def close(self):
+        self._stop.set()
+        if self._thread:
+            await asyncio.to_thread(self._thread.join)
+            self._thread = None
+
+    def _capture_loop(self):
+        while not self._stop.is_set():
+            capture = cv2.VideoCapture(self._capture_url)
+            # do not let FFmpeg buffer frames, only the latest one is of interest
+            capture.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+            if not capture.isOpened():
+                logging.error(f"Невозможно открыть поток {self.url}")
+            while not self._stop.is_set() and capture.isOpened():
+                ok, frame = capture.read()
+                if not ok:
+                    logging.error(f"Поток {self.url} прервался")
+                    break
+                self._frame = frame
+                self._frame_seq += 1
+                self._loop.call_soon_threadsafe(self._frame_ready.set)
+            capture.release()
+            self._stop.wait(self.reconnect_delay)
+
+    async def read(self):
+        if self._thread is None:
+            await self.open()
+        while self._frame_seq == self._read_seq:
+            self._frame_ready.clear()
+            try:
+                await asyncio.wait_for(self._frame_ready.wait(), self.timeout)
+            except asyncio.TimeoutError:
+                raise FrameUnavailableError(f"Нет новых кадров из потока {self.url} за {self.timeout} с")
+        frame, self._read_seq = self._frame, self._frame_seq
+        if self.recorder:
+            # the capture thread puts every frame into a new array, the recorded one stays intact
+            self.recorder.record_image(frame)
+        started = time.perf_counter()
+        image = self.preprocessor.convert_frame(frame)
+        self.decode_ms = (time.perf_counter() - started) * 1000
+        return image
+
+
+class ReplayFrameSource(FrameSource):
+    """Feeds the frames archived by `FrameRecorder` back, at the recorded pace or as fast as they are asked for.
+    `url` is the path of the recording."""
+
+    def __init__(self, url: str, preprocessor: FramePreprocessor | None = None, realtime: bool = True,
+                 loop: bool = False):
+        super().__init__(url, preprocessor)
+        if not os.path.isfile(url):
+            raise FileNotFoundError(f"Запись кадров {url} не найдена")
+        self.realtime = realtime
+        # start over when the recording ends
+        self.loop = loop
+        self._frames = None
+        # recorded timestamp minus the monotonic time it is replayed at
+        self._offset: float | None = None
+
+    async def open(self):
+        self._frames = read_recording(self.url)
+        self._offset = None
+
+    async def close(self):
+        if self._frames:
+            self._frames.close()
+            self._frames = None
+
+    async def _next_frame(self):
+        return await asyncio.to_thread(next, self._frames, None)
+
+    async def read(self):
+        if self._frames is None:
+            await self.open()
+        record = await self._next_frame()
+        if record is None and self.loop:
+            await self.open()
+            record = await self._next_frame()
+        if record is None:
+            raise FrameUnavailableError(f"Запись кадров {self.url} закончилась")
+        timestamp, jpeg = record
+        if self.realtime:
+            now = time.monotonic()
+            if self._offset is None:
+                self._offset = timestamp - now
+            delay = timestamp - self._offset - now
+            if delay > 0:
+                await asyncio.sleep(delay)
+        started = time.perf_counter()
+        image = self.preprocessor.decode_jpeg(jpeg)
+        self.decode_ms = (time.perf_counter() - started) * 1000
+        if image is None:
+            raise cv2.error(f"Невозможно декодировать JPEG размером {len(jpeg)} байт")
+        return image
+
+
+def create_frame_source(kind: str, url: str, preprocessor: FramePreprocessor | None = None,
+                        credentials: Tuple[str, str] | None = None, replay_realtime: bool = True,
+                        replay_loop: bool = False) -> FrameSource:
+    """`credentials` are the user name and password of the camera, for HTTP Digest authentication"""
+    if kind == 'snapshot':
+        return SnapshotFrameSource(url, preprocessor, auth=httpx.DigestAuth(*credentials) if credentials else None)
+    if kind == 'stream':
+        return StreamFrameSource(url, preprocessor, credentials=credentials)
+    if kind == 'replay':
+        return ReplayFrameSource(url, preprocessor, realtime=replay_realtime, loop=replay_loop)
+    raise ValueError(f"Unknown frame source [{kind}]: should be one of {FRAME_SOURCE_KINDS}")
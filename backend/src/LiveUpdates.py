@@ -0,0 +1,47 @@
+import asyncio
+import threading
+from typing import Tuple
+
+
+class LiveUpdates:
+    """Latest snapshot of a packing line for the web interface and a channel announcing its changes.
+
+    Publishers call `publish` from any thread, web clients await `wait` until the snapshot changes.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = 0
+        self._snapshot = {}
+        # (loop, event) of every waiting client
+        self._waiters = set()
+
+    def publish(self, snapshot: dict) -> None:
+        with self._lock:
+            if snapshot == self._snapshot:
+                return
+            self._snapshot = snapshot
+            self._version += 1
+            waiters = list(self._waiters)
+        for loop, event in waiters:
+            loop.call_soon_threadsafe(event.set)
+
+    def snapshot(self) -> Tuple[int, dict]:
+        with self._lock:
+            return self._version, self._snapshot
+
+    async def wait(self, version: int, timeout: float | None = None) -> Tuple[int, dict]:
+        """Waits until the snapshot is newer than `version` or `timeout` seconds pass"""
+        waiter = (asyncio.get_running_loop(), asyncio.Event())
+        with self._lock:
+            if self._version != version:
+                return self._version, self._snapshot
+            self._waiters.add(waiter)
+        try:
+            await asyncio.wait_for(waiter[1].wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            with self._lock:
+                self._waiters.discard(waiter)
+        return self.snapshot()
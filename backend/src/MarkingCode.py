@@ -0,0 +1,45 @@
+import base64
+
+
+class MarkingCode:
+    """Raw bytes of a decoded Data Matrix code.
+
+    Codes are kept as bytes all the way from the decoder to the database, base64 text is only produced for the
+    HTTP API and the exported files.
+    """
+    __slots__ = ('data',)
+
+    def __init__(self, data: bytes):
+        self.data = data
+
+    @classmethod
+    def from_base64(cls, text: str) -> 'MarkingCode':
+        return cls(base64.b64decode(text))
+
+    def to_base64(self) -> str:
+        return base64.b64encode(self.data).decode('ascii')
+
+    def __eq__(self, other):
+        if isinstance(other, MarkingCode):
+            return self.data == other.data
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(self.data)
+
+    def __lt__(self, other):
+        if isinstance(other, MarkingCode):
+            return self.data < other.data
+        return NotImplemented
+
+    def __len__(self):
+        return len(self.data)
+
+    def __bytes__(self):
+        return self.data
+
+    def __str__(self):
+        return self.to_base64()
+
+    def __repr__(self):
+        return f"MarkingCode({self.data!r})"
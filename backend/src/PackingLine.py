@@ -0,0 +1,104 @@
+import asyncio
+import json
+import logging
+import os
+from datetime import datetime
+from typing import List
+
+from backend.src.BoxMarker import BoxMarker
+from backend.src.DataMatrixDecoder import DataMatrixDecoder
+from backend.src.DatabaseManager import DatabaseManager
+from backend.src.DecodeExecutor import DecodeExecutor
+from backend.src.DecodeTuner import DecodeTuner
+from backend.src.FileSaver import FileSaver
+from backend.src.FrameBuffer import FrameBuffer, FrameBufferPolicy
+from backend.src.FramePreprocessor import FramePreprocessor
+from backend.src.FrameRecorder import FrameRecorder
+from backend.src.FrameSource import create_frame_source
+from backend.src.PreviewService import PreviewService
+from backend.src.code_checkers import parse_ka, parse_km
+
+
+class LineConfig:
+    """Camera of a packing line and the box it is aggregating"""
+
+    def __init__(self, name: str, url: str, expected_num: int, timeout: int, max_failed_attempts: int,
+                 source: str = 'snapshot'):
+        self.name = name
+        self.url = url
+        self.expected_num = expected_num
+        # milliseconds
+        self.timeout = timeout
+        self.max_failed_attempts = max_failed_attempts
+        # how frames are fetched from the camera, one of FRAME_SOURCE_KINDS
+        self.source = source
+
+
+def load_line_configs(path: str, timeout: int, max_failed_attempts: int,
+                      source: str = 'snapshot') -> List[LineConfig]:
+    """Reads a JSON list of lines: `name`, `url`, `expected_num` and optional `timeout` (seconds),
+    `max_failed_attempts` and `source`. Missing optional values are taken from the arguments."""
+    with open(path) as file:
+        lines = json.load(file)
+    configs = [LineConfig(name=line['name'], url=line['url'], expected_num=int(line['expected_num']),
+                          timeout=int(line.get('timeout', timeout / 1000) * 1000),
+                          max_failed_attempts=int(line.get('max_failed_attempts', max_failed_attempts)),
+                          source=line.get('source', source))
+               for line in lines]
+    names = [config.name for config in configs]
+    if not configs or len(set(names)) != len(names):
+        raise ValueError(f"Линии в {path} должны быть заданы и иметь уникальные имена: {names}")
+    return configs
+
+
+class PackingLine:
+    """Fetch/decode pipeline of one camera with its own box marker. Lines share the decode executor
+    and the database."""
+
+    def __init__(self, config: LineConfig, db_manager: DatabaseManager, decode_executor: DecodeExecutor | None,
+                 max_in_flight: int, results_dir: str = 'results', tile_workers: int = 0,
+                 preprocessor: FramePreprocessor | None = None, auto_tune: bool = False,
+                 frame_buffer_size: int = 2, frame_buffer_policy: FrameBufferPolicy = FrameBufferPolicy.DROP_OLDEST,
+                 preview_fps: float = 5.0, preview_quality: int = 50, record_dir: str | None = None,
+                 replay_realtime: bool = True, replay_loop: bool = False):
+        self.name = config.name
+        self.file_saver = FileSaver(results_dir=results_dir, line=self.name)
+        self.box_marker = BoxMarker(file_saver=self.file_saver, expected_bottles_number=config.expected_num,
+                                    max_failed_attempts=config.max_failed_attempts, db_manager=db_manager,
+                                    line=self.name)
+        self.file_saver.subscribe(self.box_marker)
+        self.preview = PreviewService(max_fps=preview_fps, quality=preview_quality)
+        frame_source = create_frame_source(config.source, config.url, preprocessor,
+                                           credentials=('admin', 'salek2025'),
+                                           replay_realtime=replay_realtime, replay_loop=replay_loop)
+        self.recorder = None
+        if record_dir:
+            self.recorder = FrameRecorder(os.path.join(
+                record_dir, f"{self.name}_{datetime.now().strftime('%Y-%m-%d_%H.%M.%S')}.dmxrec"))
+            frame_source.recorder = self.recorder
+        tuners = None
+        if auto_tune:
+            # bottle and aggregation codes are learned separately
+            tuners = {parse_km: DecodeTuner(path=os.path.join(results_dir, 'decoder_tuning.json')),
+                      parse_ka: DecodeTuner(path=os.path.join(results_dir, 'decoder_tuning_ka.json'))}
+        self.decoder = DataMatrixDecoder(
+            url=config.url, max_count=config.expected_num, timeout=config.timeout,
+            callback=self.box_marker.process_detected_codes, decode_executor=decode_executor,
+            tile_workers=tile_workers, preprocessor=preprocessor, tuners=tuners,
+            decode_request=self.box_marker.get_decode_request, max_in_flight=max_in_flight,
+            preview=self.preview, frame_source=frame_source,
+            frame_buffer=FrameBuffer(frame_buffer_size, frame_buffer_policy), line=self.name)
+        self.decoder.subscribe(self.box_marker)
+        logging.info(f"Линия `{self.name}`: камера {config.url} ({config.source}), "
+                     f"бутылок в коробке {config.expected_num}")
+
+    def get_frame_stats(self) -> dict:
+        return self.decoder.get_frame_stats()
+
+    async def run(self):
+        await asyncio.gather(self.box_marker.run(), self.decoder.run())
+
+    def close(self):
+        self.file_saver.close()
+        if self.recorder:
+            self.recorder.close()
@@ -0,0 +1,79 @@
+import logging
+import threading
+import time
+from typing import Tuple
+
+import cv2
+import numpy
+
+
+class PreviewService:
+    """Latest camera frame with the decoded regions outlined, for the web interface.
+
+    The decoder only hands over references to the frame and its regions. The annotated JPEG is produced when a
+    client asks for it, at most `max_fps` times a second, and kept in memory until a newer frame is encoded.
+    """
+
+    def __init__(self, placeholder_path: str = 'no_image_available.jpg', max_fps: float = 5.0, quality: int = 50,
+                 scale: float = 1 / 3):
+        self.min_interval = 1 / max_fps if max_fps > 0 else 0.0
+        self.quality = quality
+        self.scale = scale
+        try:
+            with open(placeholder_path, 'rb') as file:
+                self._placeholder = file.read()
+        except OSError as e:
+            logging.error(f"Невозможно прочитать картинку {placeholder_path}: {e}")
+            self._placeholder = b''
+        self._lock = threading.Lock()
+        # latest frame: image, regions in camera frame pixels, how much the image is reduced against the camera frame
+        self._frame = None
+        self._seq = 0
+        # latest encoded frame
+        self._jpeg = self._placeholder
+        self._jpeg_seq = 0
+        self._encoded_at = 0.0
+
+    def update(self, image, regions=(), reduction: int = 1) -> None:
+        """Replaces the latest frame. The image must not be modified afterwards."""
+        with self._lock:
+            self._frame = (image, regions, reduction)
+            self._seq += 1
+
+    def set_unavailable(self) -> None:
+        with self._lock:
+            if self._frame is not None or self._seq == 0:
+                self._frame = None
+                self._seq += 1
+
+    def jpeg(self) -> Tuple[bytes, str]:
+        """Returns the latest annotated frame as JPEG bytes and its ETag"""
+        with self._lock:
+            if self._seq != self._jpeg_seq and time.monotonic() - self._encoded_at >= self.min_interval:
+                frame, seq = self._frame, self._seq
+                try:
+                    self._jpeg = self._encode(*frame) if frame is not None else self._placeholder
+                except cv2.error as e:
+                    logging.error(f"Ошибка кодирования кадра для предпросмотра: {e}")
+                    self._jpeg = self._placeholder
+                self._jpeg_seq = seq
+                self._encoded_at = time.monotonic()
+            return self._jpeg, str(self._jpeg_seq)
+
+    def _encode(self, image, regions, reduction) -> bytes:
+        if image.ndim == 2:
+            image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+        else:
+            image = image.copy()
+        image_size = image.shape[:2]
+        # libdmtx puts the origin in the bottom left corner
+        for region in regions:
+            coords = [(corner[0] // reduction, image_size[0] - corner[1] // reduction) for corner in region.corners]
+            cv2.polylines(image, [numpy.array(coords)], True, (0, 255, 0), max(image_size) // 100)
+        if self.scale != 1:
+            image = cv2.resize(image, (int(image_size[1] * self.scale), int(image_size[0] * self.scale)),
+                               interpolation=cv2.INTER_AREA)
+        ok, buffer = cv2.imencode('.jpg', image, [int(cv2.IMWRITE_JPEG_QUALITY), self.quality])
+        if not ok:
+            raise cv2.error("JPEG encoding failed")
+        return buffer.tobytes()
@@ -0,0 +1,38 @@
+from typing import Dict, List, Tuple
+
+Corners = Tuple[Tuple[int, int], ...]
+
+
+class RegionTracker:
+    """Remembers where each code was seen on recent frames, so the next frames can be decoded around
+    these places first instead of scanning the whole image."""
+
+    def __init__(self, max_age: int = 3, padding: float = 0.5):
+        # how many frames in a row a code may be missing before it is forgotten
+        self.max_age = max_age
+        # padding around a known code, relative to its size
+        self.padding = padding
+        self._tracks: Dict[bytes, List] = {}
+
+    def update(self, decoded_messages_with_regions) -> None:
+        for track in self._tracks.values():
+            track[1] += 1
+        for msg in decoded_messages_with_regions:
+            self._tracks[msg.decoded.data] = [msg.corners, 0]
+        self._tracks = {data: track for data, track in self._tracks.items() if track[1] <= self.max_age}
+
+    def reset(self) -> None:
+        self._tracks = {}
+
+    def rois(self, image_size: Tuple[int, int]) -> List[Tuple[int, int, int, int]]:
+        """Padded bounding boxes (x0, y0, x1, y1) of known codes with the origin in the top left corner"""
+        height, width = image_size
+        rois = []
+        for corners, _ in self._tracks.values():
+            xs = [x for x, _ in corners]
+            # libdmtx counts y from the bottom of the image
+            ys = [height - y for _, y in corners]
+            pad = int(max(max(xs) - min(xs), max(ys) - min(ys)) * self.padding)
+            rois.append((max(min(xs) - pad, 0), max(min(ys) - pad, 0),
+                         min(max(xs) + pad, width), min(max(ys) + pad, height)))
+        return rois
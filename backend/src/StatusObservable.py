@@ -1,34 +1,77 @@
+import asyncio
 import logging
 from typing import Any
 import threading
 
 
 class StatusObservable:
-    status: Any = None
+    """Publishes its status to the observers whenever it changes.
+
+    Observers are called on the event loop they subscribed from, whatever thread changes the status. Changes made
+    before the loop gets to them are coalesced, observers see the latest status only.
+    """
+    _status: Any = None
 
     def __init__(self):
-        self._observers = []
+        # observer -> event loop it is called on
+        self._observers = {}
         # take a derived class name as a default name
         self._name = self.__class__.__name__
-        threading.Thread(target=self._notify_loop, daemon=True, name=f"{self._name}_notify_loop").start()
+        self._lock = threading.Lock()
+        # last status handed over to the observers
+        self._published: Any = None
+        # loops with a delivery already scheduled
+        self._scheduled = set()
+
+    @property
+    def status(self):
+        return self._status
+
+    @status.setter
+    def status(self, status):
+        self._status = status
+        self.notify()
 
-    def subscribe(self, observer):
+    def subscribe(self, observer, loop: asyncio.AbstractEventLoop | None = None):
+        """Calls `observer.update_devices` on `loop`, by default on the running loop.
+
+        Raises:
+            RuntimeError: if no loop is given and none is running.
+        """
         logging.debug(f"Subscribing {observer} to {self._name}")
-        self._observers.append(observer)
+        if loop is None:
+            loop = asyncio.get_running_loop()
+        self._observers[observer] = loop
+        if self._status is not None:
+            observer.update_devices(self._status)
 
     def unsubscribe(self, observer):
         logging.debug(f"Unsubscribing {observer} from {self._name}")
-        self._observers.remove(observer)
+        self._observers.pop(observer, None)
 
     def notify(self):
-        logging.debug(f"Notify {self._name} observers with value {self.status}")
-        for observer in self._observers:
-            observer.update_devices(self.status)
-
-    def _notify_loop(self):
-        while True:
-            threading.Event().wait(0.1)
-            self.notify()
+        with self._lock:
+            if self._status == self._published:
+                return
+            self._published = self._status
+            loops = set(self._observers.values()) - self._scheduled
+            self._scheduled.update(loops)
+        logging.debug(f"Notify {self._name} observers with value {self._status}")
+        for loop in loops:
+            try:
+                loop.call_soon_threadsafe(self._deliver, loop)
+            except RuntimeError:
+                # the loop is closed, nobody is listening there anymore
+                with self._lock:
+                    self._scheduled.discard(loop)
+
+    def _deliver(self, loop):
+        with self._lock:
+            self._scheduled.discard(loop)
+            status = self._status
+        for observer, observer_loop in list(self._observers.items()):
+            if observer_loop is loop:
+                observer.update_devices(status)
 
 
 class DeviceObserver:
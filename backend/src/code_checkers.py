@@ -1,22 +1,105 @@
 import base64
-import re
 import binascii
+from functools import lru_cache
+from typing import NamedTuple
 
-km_pattern = re.compile(r'^01\d{14}21\d{1}[A-Za-z0-9!@#$%^&*()_+={}\[\]:;"\'<>,.?/\\|`~\-]{6}\x1d93[A-Za-z0-9!@#$%^&*()_+={}\[\]:;"\'<>,.?/\\|`~\-]{4}$')
-ka_pattern = re.compile(r'^02\d{14}\x1d37\d{2}\x1d21[A-Za-z0-9!@#$%^&*()_+={}\[\]:;"\'<>,.?/\\|`~\-]+$')
+from backend.src.MarkingCode import MarkingCode
 
+# GS1 group separator, ends variable length fields
+GS = 0x1d
+# bytes allowed in serial numbers and verification codes
+_ALLOWED = frozenset(b'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789'
+                     b'!@#$%^&*()_+={}[]:;"\'<>,.?/\\|`~-')
+_DIGITS = frozenset(b'0123456789')
 
-def code_validator(code_pattern):
-    def validator(input_code: str, pattern):
-        try:
-            decoded_code = base64.b64decode(input_code).decode('utf-8')
-        except (binascii.Error, UnicodeDecodeError):
-            return False
-        return bool(pattern.match(decoded_code))
-    return lambda input_code: validator(input_code, code_pattern)
+# verdicts are kept for this many distinct codes, the same codes are seen on every frame
+CACHE_SIZE = 4096
 
-is_km_valid = code_validator(km_pattern)
-is_ka_valid = code_validator(ka_pattern)
+
+class Gs1Fields(NamedTuple):
+    """Application identifiers of a marking code (KM) or an aggregation code (KA)"""
+    # 01 (KM) or 02 (KA)
+    gtin: str
+    # 21
+    serial: str
+    # 37, KA only
+    count: int | None = None
+    # 93, KM only
+    check_code: str | None = None
+
+
+def _is_digits(data: bytes) -> bool:
+    return bool(data) and all(byte in _DIGITS for byte in data)
+
+
+def _is_allowed(data: bytes) -> bool:
+    return bool(data) and all(byte in _ALLOWED for byte in data)
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def parse_km(data: bytes) -> Gs1Fields | None:
+    """Parses a marking code `01<GTIN 14>21<serial 7><GS>93<check code 4>`.
+
+    Returns:
+        Gs1Fields or None if the code is not a valid marking code.
+    """
+    if len(data) != 32 or data[:2] != b'01' or data[16:18] != b'21' or data[25] != GS or data[26:28] != b'93':
+        return None
+    gtin, serial, check_code = data[2:16], data[18:25], data[28:32]
+    if not (_is_digits(gtin) and serial[0] in _DIGITS and _is_allowed(serial[1:]) and _is_allowed(check_code)):
+        return None
+    return Gs1Fields(gtin=gtin.decode('ascii'), serial=serial.decode('ascii'), check_code=check_code.decode('ascii'))
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def parse_ka(data: bytes) -> Gs1Fields | None:
+    """Parses an aggregation code `02<GTIN 14><GS>37<count 2><GS>21<serial>`.
+
+    Returns:
+        Gs1Fields or None if the code is not a valid aggregation code.
+    """
+    if len(data) < 25 or data[:2] != b'02' or data[16] != GS or data[17:19] != b'37' or data[21] != GS \
+            or data[22:24] != b'21':
+        return None
+    gtin, count, serial = data[2:16], data[19:21], data[24:]
+    if not (_is_digits(gtin) and _is_digits(count) and _is_allowed(serial)):
+        return None
+    return Gs1Fields(gtin=gtin.decode('ascii'), serial=serial.decode('ascii'), count=int(count))
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _b64decode(code: str) -> bytes | None:
+    try:
+        return base64.b64decode(code)
+    except (binascii.Error, ValueError):
+        return None
+
+
+def _raw(code: MarkingCode | str | bytes) -> bytes | None:
+    """Raw code bytes, base64 strings are decoded"""
+    if isinstance(code, MarkingCode):
+        return code.data
+    return _b64decode(code) if isinstance(code, str) else bytes(code)
+
+
+def is_km_valid(code: MarkingCode | str | bytes) -> bool:
+    data = _raw(code)
+    return data is not None and parse_km(data) is not None
+
+
+def is_ka_valid(code: MarkingCode | str | bytes) -> bool:
+    data = _raw(code)
+    return data is not None and parse_ka(data) is not None
+
+
+def km_fields(code: MarkingCode | str | bytes) -> Gs1Fields | None:
+    data = _raw(code)
+    return parse_km(data) if data is not None else None
+
+
+def ka_fields(code: MarkingCode | str | bytes) -> Gs1Fields | None:
+    data = _raw(code)
+    return parse_ka(data) if data is not None else None
 
 # # Пример использования
 # kms = ["MDEwNDY4MDU3MTA2MTIyNjIxNVlGWC8wbh05M1VlVSs=",
@@ -26,9 +109,9 @@ is_ka_valid = code_validator(ka_pattern)
 #                  "MDEwNDY4MDU3MTA2MTIyNjIxNS9LO2hZMB05M2VQd0g="]
 #
 # for code in kms:
-#     print(base64.b64decode(code).decode("utf-8"), marking_code_validator(code))  # True или False
+#     print(base64.b64decode(code).decode("utf-8"), km_fields(code))  # Gs1Fields или None
 #
 # kas = ["MDIwNDY4MDU3MTA2MTIyNh0zNzEyHTIxQUEwMzM=",]
 #
 # for code in kas:
-#     print(base64.b64decode(code).decode("utf-8"), aggregate_code_validator(code))  # True или False
\ No newline at end of file
+#     print(base64.b64decode(code).decode("utf-8"), ka_fields(code))  # Gs1Fields или None
@@ -0,0 +1,213 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Tuple
+
+# seconds, from a fast lookup to a slow camera
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class MetricsRegistry:
+    """Metrics of the application, rendered in the Prometheus text exposition format"""
+
+    def __init__(self):
+        self._metrics: Dict[str, 'Metric'] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: 'Metric') -> None:
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric [{metric.name}] is already registered")
+            self._metrics[metric.name] = metric
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 registry: MetricsRegistry | None = REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        if registry is not None:
+            registry.register(self)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple:
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f"Metric [{self.name}] expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(labels[name] for name in self.labelnames)
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def _value_samples(self, values: Dict[Tuple, float | Callable[[], float]]) -> List[str]:
+        """Samples of values by labels, functions are called and skipped when they return None"""
+        with self._lock:
+            values = list(values.items())
+        samples = []
+        for key, value in values:
+            if callable(value):
+                value = value()
+                if value is None:
+                    continue
+            samples.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return samples
+
+
+class Counter(Metric):
+    """Total incremented by the code or read from a function counting on its own when the metrics are rendered"""
+    kind = 'counter'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[Tuple, float | Callable[[], float]] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            value = self._values.get(key, 0)
+            if callable(value):
+                raise ValueError(f"Metric [{self.name}] is read from a function, it can not be incremented")
+            self._values[key] = value + amount
+
+    def set_function(self, function: Callable[[], float], **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = function
+
+    def samples(self) -> List[str]:
+        return self._value_samples(self._values)
+
+
+class Gauge(Metric):
+    """Value set by the code or read from a function when the metrics are rendered"""
+    kind = 'gauge'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[Tuple, float | Callable[[], float]] = {}
+
+    def set(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def set_function(self, function: Callable[[], float], **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = function
+
+    def remove(self, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values.pop(key, None)
+
+    def samples(self) -> List[str]:
+        return self._value_samples(self._values)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, *args, buckets: Tuple[float, ...] = DEFAULT_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(sorted(buckets))
+        # per labels: counts of observations falling into each bucket (not cumulative) and above the last one, sum
+        self._values: Dict[Tuple, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.get(key) or self._values.setdefault(key, ([0] * (len(self.buckets) + 1),
+                                                                                   [0.0]))
+            counts[index] += 1
+            total[0] += value
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = [(key, list(counts), total[0]) for key, (counts, total) in self._values.items()]
+        samples = []
+        for key, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, f'le="{_format_value(bound)}"')
+                samples.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            samples.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            samples.append(f"{self.name}_count{labels} {cumulative}")
+        return samples
+
+
+# metrics of the pipeline stages, seconds
+STAGE_SECONDS = Histogram('datamatrix_stage_seconds',
+                          'Time spent in a stage of a frame: '
+                          'fetch, jpeg, resize, clahe, threshold, decode_rois, decode, job', ('line', 'stage'))
+FRAMES = Counter('datamatrix_frames_total', 'Decoded frames', ('line',))
+CODES = Counter('datamatrix_codes_total', 'Codes found on decoded frames', ('line',))
+FRAME_ERRORS = Counter('datamatrix_frame_errors_total', 'Frames lost to errors', ('line', 'kind'))
+FRAMES_PER_SECOND = Gauge('datamatrix_frames_per_second', 'Decoded frames per second over the last frames',
+                          ('line',))
+FRAME_BUFFER_DEPTH = Gauge('datamatrix_frame_buffer_depth', 'Frames waiting for a decode slot', ('line',))
+FRAME_BUFFER_DROPPED = Counter('datamatrix_frame_buffer_dropped_total', 'Frames dropped by the frame buffer',
+                               ('line',))
+DECODE_EXECUTOR_RESTARTS = Counter('datamatrix_decode_executor_restarts_total',
+                                   'Decode worker pools rebuilt after a worker died', ('kind',))
+DECODES_IN_FLIGHT = Gauge('datamatrix_decodes_in_flight', 'Frames being decoded or waiting for their turn',
+                          ('line',))
+
+VALIDATION_SECONDS = Histogram('box_marker_validation_seconds', 'Time spent validating the codes of a frame',
+                               ('line',))
+EVENT_SECONDS = Histogram('box_marker_event_seconds', 'Time the state machine spent on an event',
+                          ('line', 'kind'))
+TRANSITIONS = Counter('box_marker_transitions_total', 'State transitions', ('line', 'from_state', 'to_state'))
+CYCLE_SECONDS = Histogram('box_marker_cycle_seconds', 'Time from the first code of a box to its aggregation',
+                          ('line',), buckets=(1, 2, 5, 10, 15, 20, 30, 45, 60, 90, 120, 300))
+INBOX_DEPTH = Gauge('box_marker_inbox_depth', 'Events waiting for the state machine', ('line',))
+
+DATABASE_SECONDS = Histogram('database_seconds', 'Time spent in a database operation', ('operation',))
+
+FILE_WRITE_SECONDS = Histogram('file_saver_write_seconds', 'Time spent writing the files of a box', ('line',))
+FILE_WRITE_ERRORS = Counter('file_saver_write_errors_total', 'Failed attempts to write files of a box', ('line',))
+FILES_PENDING = Gauge('file_saver_pending', 'Boxes whose files are not written yet', ('line',))
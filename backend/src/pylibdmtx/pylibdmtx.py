@@ -1,7 +1,12 @@
 from __future__ import print_function
 
 import ctypes
+import os
+import sys
+import threading
+import time
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from contextlib import contextmanager
 from ctypes import byref, cast, string_at
 from functools import partial
@@ -12,7 +17,7 @@ from .wrapper import (
     dmtxDecodeDestroy, dmtxRegionDestroy, dmtxMessageDestroy, dmtxTimeAdd,
     dmtxTimeNow, dmtxDecodeMatrixRegion, dmtxRegionFindNext,
     dmtxMatrix3VMultiplyBy, dmtxDecodeSetProp, DmtxPackOrder, DmtxProperty,
-    DmtxUndefined, DmtxVector2, EXTERNAL_DEPENDENCIES,
+    DmtxUndefined, DmtxVector2, DmtxTime, EXTERNAL_DEPENDENCIES,
     DmtxSymbolSize, DmtxScheme, dmtxEncodeSetProp, dmtxEncodeDataMatrix,
     dmtxImageGetProp, dmtxEncodeCreate, dmtxEncodeDestroy
 )
@@ -41,6 +46,13 @@ Rect = namedtuple('Rect', 'left top width height')
 # Results of reading a barcode
 Decoded = namedtuple('Decoded', 'data rect')
 
+# Results of reading a barcode together with the geometry of its region:
+# corners (bottom, right, top, left), symbol size index, number of modules
+# along the longer side and the strength of the edge the region was found by
+DecodedRegion = namedtuple(
+    'DecodedRegion', 'decoded corners size_idx modules edge_strength'
+)
+
 # Results of encoding data to an image
 Encoded = namedtuple('Encoded', 'width height bpp pixels')
 
@@ -180,43 +192,53 @@ def _decode_region(decoder, region, corrections, shrink):
 def _pixel_data(image):
     """Returns (pixels, width, height, bpp)
 
+    `pixels` is either `bytes` or a C-contiguous `uint8` `numpy.ndarray`. The
+    buffer of the array is handed to libdmtx as is, without copying, so it
+    must stay referenced while the `DmtxImage` is alive.
+
     Returns:
         :obj: `tuple` (pixels, width, height, bpp)
     """
     # Test for PIL.Image, numpy.ndarray, and imageio.core.util without
-    # requiring that cv2, PIL, or imageio are installed.
+    # requiring that cv2, PIL, or imageio are installed: an image of such a
+    # type can only exist if its module has already been imported.
+    numpy = sys.modules.get('numpy')
+    pil_image = sys.modules.get('PIL.Image')
 
-    image_type = str(type(image))
-    if 'PIL.' in image_type:
+    if pil_image is not None and isinstance(image, pil_image.Image):
         pixels = image.tobytes()
         width, height = image.size
-    elif 'numpy.ndarray' in image_type or 'imageio.core.util' in image_type:
+        size = len(pixels)
+    elif numpy is not None and isinstance(image, numpy.ndarray):
         # Different versions of imageio use a subclass of numpy.ndarray
         # called either imageio.core.util.Image or imageio.core.util.Array.
-        if 'uint8' != str(image.dtype):
-            image = image.astype('uint8')
-        try:
-            pixels = image.tobytes()
-        except AttributeError:
-            # `numpy.ndarray.tobytes()` introduced in `numpy` 1.9.0 - use the
-            # older `tostring` method.
-            pixels = image.tostring()
+        if image.dtype != numpy.uint8:
+            image = image.astype(numpy.uint8)
+        if image.ndim == 3 and image.shape[2] == 1:
+            # Single channel image is packed as 8bpp grayscale
+            image = image.reshape(image.shape[:2])
+        if not image.flags.c_contiguous:
+            # Slices of a larger image, e.g. tiles, have gaps between rows
+            image = numpy.ascontiguousarray(image)
+        pixels = image
         height, width = image.shape[:2]
+        size = image.nbytes
     else:
         # image should be a tuple (pixels, width, height)
         pixels, width, height = image
+        size = len(pixels)
 
         # Check dimensions
-        if 0 != len(pixels) % (width * height):
+        if 0 != size % (width * height):
             raise PyLibDMTXError(
                 (
                     'Inconsistent dimensions: image data of {0} bytes is not '
                     'divisible by (width x height = {1})'
-                ).format(len(pixels), (width * height))
+                ).format(size, (width * height))
             )
 
     # Compute bits-per-pixel
-    bpp = 8 * len(pixels) // (width * height)
+    bpp = 8 * size // (width * height)
     if bpp not in _PACK_ORDER:
         raise PyLibDMTXError(
             'Unsupported bits-per-pixel: [{0}] Should be one of {1}'.format(
@@ -227,6 +249,15 @@ def _pixel_data(image):
     return pixels, width, height, bpp
 
 
+def _pixel_pointer(pixels):
+    """Returns a `c_ubyte_p` to pixels returned by `_pixel_data`.
+    """
+    if isinstance(pixels, bytes):
+        return cast(pixels, c_ubyte_p)
+    # The pointer keeps a reference to the array
+    return pixels.ctypes.data_as(c_ubyte_p)
+
+
 def decode(image, timeout=None, gap_size=None, shrink=1, shape=None,
            deviation=None, threshold=None, min_edge=None, max_edge=None,
            corrections=None, max_count=None):
@@ -261,7 +292,7 @@ def decode(image, timeout=None, gap_size=None, shrink=1, shape=None,
 
     results = []
     with _image(
-        cast(pixels, c_ubyte_p), width, height, _PACK_ORDER[bpp]
+        _pixel_pointer(pixels), width, height, _PACK_ORDER[bpp]
     ) as img:
         with _decoder(img, shrink) as decoder:
             properties = [
@@ -301,22 +332,83 @@ def decode(image, timeout=None, gap_size=None, shrink=1, shape=None,
 
     return results
 
-def decode_with_regions(image, timeout=None, gap_size=None, shrink=1, shape=None,
-           deviation=None, threshold=None, min_edge=None, max_edge=None,
-           corrections=None, max_count=None):
+def _dmtx_deadline(timeout=None, deadline=None):
+    """Returns the `DmtxTime` to stop scanning at: `timeout` milliseconds from
+    now or the absolute `deadline` (seconds since the epoch, as returned by
+    `time.time`), whichever comes first. `None` if neither is given.
+    """
     dmtx_timeout = None
     if timeout:
         now = dmtxTimeNow()
         dmtx_timeout = dmtxTimeAdd(now, timeout)
+    if deadline is not None:
+        dmtx_deadline = DmtxTime(int(deadline), int((deadline % 1) * 1000000))
+        if dmtx_timeout is None or (dmtx_deadline.sec, dmtx_deadline.usec) < (
+                dmtx_timeout.sec, dmtx_timeout.usec):
+            dmtx_timeout = dmtx_deadline
+    return dmtx_timeout
+
+
+def decode_with_regions(image, timeout=None, gap_size=None, shrink=1, shape=None,
+           deviation=None, threshold=None, min_edge=None, max_edge=None,
+           corrections=None, max_count=None, deadline=None):
+    """Decodes datamatrix barcodes in `image` the same way as `decode`.
+
+    Args:
+        deadline (float): absolute time to stop scanning at, in seconds since
+            the epoch. Used together with `timeout` the earlier one wins.
+        Other arguments are the same as in `decode`.
+
+    Returns:
+        :obj:`list` of :obj:`DecodedRegion`: The values decoded from barcodes
+        with the corners of their regions. Coordinates have their origin in
+        the bottom left corner of the image.
+    """
+    return list(iter_decode_with_regions(
+        image, timeout, gap_size, shrink, shape, deviation, threshold,
+        min_edge, max_edge, corrections, max_count, deadline
+    ))
 
+
+def iter_decode_with_regions(image, timeout=None, gap_size=None, shrink=1,
+                             shape=None, deviation=None, threshold=None,
+                             min_edge=None, max_edge=None, corrections=None,
+                             max_count=None, deadline=None):
+    """Same as `decode_with_regions`, but yields every barcode as soon as it
+    is decoded. Closing the generator stops the scan.
+
+    Yields:
+        DecodedRegion: The value decoded from a barcode with its region.
+    """
     if max_count is not None and max_count < 1:
         raise ValueError('Invalid max_count [{0}]'.format(max_count))
 
+    return _iter_decode_with_regions(
+        image, _dmtx_deadline(timeout, deadline), gap_size, shrink, shape,
+        deviation, threshold, min_edge, max_edge, corrections, max_count
+    )
+
+
+def _decode_with_regions(image, dmtx_timeout, gap_size, shrink, shape,
+                         deviation, threshold, min_edge, max_edge,
+                         corrections, max_count):
+    """Body of `decode_with_regions` taking an already computed `DmtxTime`
+    deadline, so that several images can share the same one.
+    """
+    return list(_iter_decode_with_regions(
+        image, dmtx_timeout, gap_size, shrink, shape, deviation, threshold,
+        min_edge, max_edge, corrections, max_count
+    ))
+
+
+def _iter_decode_with_regions(image, dmtx_timeout, gap_size, shrink, shape,
+                              deviation, threshold, min_edge, max_edge,
+                              corrections, max_count):
     pixels, width, height, bpp = _pixel_data(image)
 
-    results = []
+    count = 0
     with _image(
-            cast(pixels, c_ubyte_p), width, height, _PACK_ORDER[bpp]
+            _pixel_pointer(pixels), width, height, _PACK_ORDER[bpp]
     ) as img:
         with _decoder(img, shrink) as decoder:
             properties = [
@@ -348,16 +440,199 @@ def decode_with_regions(image, timeout=None, gap_size=None, shrink=1, shape=None
                         )
                         if res:
 
-                            results.append((res, ((region.contents.bottomLoc.X, region.contents.bottomLoc.Y),
-                                                  (region.contents.rightLoc.X, region.contents.rightLoc.Y),
-                                                  (region.contents.topLoc.X, region.contents.topLoc.Y),
-                                                  (region.contents.leftLoc.X, region.contents.leftLoc.Y))))
+                            reg = region.contents
+                            # Region is located on the image shrunk by `shrink`
+                            corners = tuple(
+                                (shrink * loc.X, shrink * loc.Y) for loc in
+                                (reg.bottomLoc, reg.rightLoc, reg.topLoc, reg.leftLoc)
+                            )
+                            yield DecodedRegion(
+                                res, corners, reg.sizeIdx,
+                                max(reg.symbolRows, reg.symbolCols),
+                                reg.flowBegin.mag
+                            )
+                            count += 1
 
                             # Stop if we've reached maximum count
-                            if max_count and len(results) == max_count:
+                            if max_count and count == max_count:
                                 break
 
-    return results
+
+def _tile_starts(length, tile_size, step):
+    """Start offsets of tiles of `tile_size` covering `length` pixels, the
+    last tile is aligned to the end of the image.
+    """
+    if length <= tile_size:
+        return [0]
+    starts = list(range(0, length - tile_size, step))
+    starts.append(length - tile_size)
+    return starts
+
+
+# thread pools of `decode_with_regions_tiled` by (process id, workers), kept
+# for the life of the process instead of being started for every frame
+_TILE_POOLS = {}
+_TILE_POOLS_LOCK = threading.Lock()
+
+
+def _tile_pool(workers):
+    """The thread pool of this process decoding tiles with `workers` threads.
+    Concurrent calls share it, so a process never runs more tile threads.
+    """
+    # a forked worker process does not inherit the threads of the parent
+    key = (os.getpid(), workers)
+    with _TILE_POOLS_LOCK:
+        pool = _TILE_POOLS.get(key)
+        if pool is None:
+            pool = _TILE_POOLS[key] = ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix='dmtx_tile'
+            )
+        return pool
+
+
+def _offset_region(result, dx, dy):
+    """Translates a `decode_with_regions` result by (`dx`, `dy`). libdmtx
+    coordinates have their origin in the bottom left corner of the image.
+    """
+    rect = result.decoded.rect
+    return result._replace(
+        decoded=Decoded(result.decoded.data, Rect(rect.left + dx, rect.top + dy, rect.width, rect.height)),
+        corners=tuple((x + dx, y + dy) for x, y in result.corners)
+    )
+
+
+def decode_with_regions_tiled(image, timeout=None, gap_size=None, shrink=1,
+                              shape=None, deviation=None, threshold=None,
+                              min_edge=None, max_edge=None, corrections=None,
+                              max_count=None, tile_size=None, overlap=None,
+                              workers=None, deadline=None):
+    """Decodes datamatrix barcodes in `image` by splitting it into overlapping
+    tiles which are scanned in parallel. libdmtx calls release the GIL, so
+    tiles are decoded on a thread pool.
+
+    Args:
+        image: `numpy.ndarray`. Other image types are decoded in one piece.
+        timeout (int): milliseconds, shared by all tiles
+        deadline (float): absolute time to stop scanning at, see
+            `decode_with_regions`
+        max_edge (int): required unless both `tile_size` and `overlap` are
+            given; tiles overlap enough to fully contain a symbol of this
+            size in any rotation.
+        tile_size (int): side of a tile in pixels, defaults to three overlaps
+        overlap (int): overlap of neighbouring tiles in pixels
+        workers (int): number of threads, defaults to the number of CPUs.
+            The threads are kept for the next calls.
+        Other arguments are the same as in `decode`.
+
+    Returns:
+        :obj:`list` of :obj:`DecodedRegion`: same as `decode_with_regions`,
+        with coordinates in the frame coordinate system. Symbols found in
+        several tiles are reported once.
+    """
+    if overlap is None and max_edge is not None:
+        # diagonal of a symbol rotated by 45 degrees
+        overlap = int(max_edge * 1.5)
+    if tile_size is None and overlap is not None:
+        tile_size = 3 * overlap
+    if not hasattr(image, 'shape') or tile_size is None or overlap is None:
+        return decode_with_regions(
+            image, timeout, gap_size, shrink, shape, deviation, threshold,
+            min_edge, max_edge, corrections, max_count, deadline
+        )
+    if overlap >= tile_size:
+        raise ValueError(
+            'Tile overlap [{0}] must be smaller than tile size [{1}]'.format(
+                overlap, tile_size
+            )
+        )
+    if max_count is not None and max_count < 1:
+        raise ValueError('Invalid max_count [{0}]'.format(max_count))
+
+    dmtx_timeout = _dmtx_deadline(timeout, deadline)
+    # tiles which have not started yet are skipped past this time
+    stop_at = deadline
+    if timeout:
+        stop_at = min(time.time() + timeout / 1000.0, stop_at or float('inf'))
+
+    height, width = image.shape[:2]
+    step = tile_size - overlap
+    tiles = [
+        (x0, y0, min(x0 + tile_size, width), min(y0 + tile_size, height))
+        for y0 in _tile_starts(height, tile_size, step)
+        for x0 in _tile_starts(width, tile_size, step)
+    ]
+    # set when enough symbols are found, tiles already being scanned finish
+    stop = threading.Event()
+
+    def decode_tile(tile):
+        if stop.is_set() or (stop_at is not None and time.time() >= stop_at):
+            return []
+        x0, y0, x1, y1 = tile
+        found = _decode_with_regions(
+            image[y0:y1, x0:x1], dmtx_timeout, gap_size, shrink, shape,
+            deviation, threshold, min_edge, max_edge, corrections, max_count
+        )
+        return [_offset_region(res, x0, height - y1) for res in found]
+
+    results = {}
+    pool = _tile_pool(workers or os.cpu_count())
+    futures = [pool.submit(decode_tile, tile) for tile in tiles]
+    try:
+        for future in as_completed(futures):
+            for res in future.result():
+                # symbols lying in the overlap of tiles are found several times
+                results.setdefault(res[0].data, res)
+            if max_count and len(results) >= max_count:
+                break
+    finally:
+        stop.set()
+        for pending in futures:
+            pending.cancel()
+
+    return list(results.values())[:max_count]
+
+
+def decode_with_regions_in_rois(image, rois, timeout=None, gap_size=None,
+                                shrink=1, shape=None, deviation=None,
+                                threshold=None, min_edge=None, max_edge=None,
+                                corrections=None, max_count=None,
+                                deadline=None):
+    """Decodes at most one datamatrix barcode inside each region of interest.
+
+    Args:
+        image: `numpy.ndarray`
+        rois: sequence of (x0, y0, x1, y1) pixel rectangles with the origin
+            in the top left corner of the image, the same way `image` is
+            sliced.
+        timeout (int): milliseconds, shared by all regions of interest
+        deadline (float): absolute time to stop scanning at, see
+            `decode_with_regions`
+        Other arguments are the same as in `decode`.
+
+    Returns:
+        :obj:`list` of :obj:`DecodedRegion`: same as `decode_with_regions`,
+        with coordinates in the frame coordinate system.
+    """
+    if max_count is not None and max_count < 1:
+        raise ValueError('Invalid max_count [{0}]'.format(max_count))
+
+    dmtx_timeout = _dmtx_deadline(timeout, deadline)
+
+    height = image.shape[0]
+    results = {}
+    for x0, y0, x1, y1 in rois:
+        found = _decode_with_regions(
+            image[y0:y1, x0:x1], dmtx_timeout, gap_size, shrink, shape,
+            deviation, threshold, min_edge, max_edge, corrections, 1
+        )
+        for res in found:
+            # neighbouring regions of interest may see the same symbol
+            results.setdefault(res[0].data, _offset_region(res, x0, height - y1))
+        if max_count and len(results) >= max_count:
+            break
+
+    return list(results.values())
+
 
 @contextmanager
 def _encoder():
@@ -0,0 +1,336 @@
+"""Offline benchmark of the DataMatrix decoders on a corpus of synthetic box images.
+
+    python -m benchmarks.decode_benchmark --frames 60 --configs decode_frame decode_frame_reduced2
+    python -m benchmarks.decode_benchmark --save_baseline
+
+Run from the repository root. Box images are generated once from marking codes encoded by the project's pylibdmtx,
+with varying code count, rotation, blur, noise and scale, and saved to `--corpus` as JPEG frames together with a
+manifest of their codes. Later runs with the same generation parameters reuse the recorded corpus.
+
+Every decoder configuration decodes every frame, from JPEG bytes to codes. Frames per second, p50/p95 latency,
+recall and CPU time are reported and compared against the baseline: a result worse than the tolerance fails the run.
+Baselines are only comparable on the same machine.
+"""
+import argparse
+import base64
+import json
+import math
+import os
+import platform
+import sys
+import time
+from typing import Callable, Dict, List, NamedTuple
+
+import cv2
+import numpy
+
+from backend.src.DataMatrixDecoder import decode_frame
+from backend.src.FramePreprocessor import FramePreprocessor
+from backend.src.pylibdmtx import pylibdmtx
+from backend.src.pylibdmtx.wrapper import dmtxVersion
+
+# height, width of the camera frame
+FRAME_SIZE = (960, 1280)
+# values a frame draws its generation parameters from
+AXES = {
+    'count': (1, 4, 6, 12, 20),
+    # degrees
+    'rotation': (0, 10, 30, 45),
+    # sigma of the gaussian blur, pixels
+    'blur': (0.0, 0.8, 1.5),
+    # standard deviation of the gaussian noise, gray levels
+    'noise': (0.0, 4.0, 10.0),
+    # of the symbols as encoded by libdmtx, 5 pixels per module
+    'scale': (0.6, 0.8, 1.0, 1.3),
+}
+JPEG_QUALITY = 90
+_SERIAL_CHARS = b'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789'
+
+
+class Frame(NamedTuple):
+    name: str
+    jpeg: bytes
+    codes: frozenset
+    params: dict
+
+
+class DecoderConfig(NamedTuple):
+    """How a frame goes from JPEG bytes to codes"""
+    preprocessor: FramePreprocessor
+    # (image, expected codes count, args) -> decoded code bytes
+    decode: Callable
+
+
+def random_km(rng: numpy.random.Generator) -> bytes:
+    """Marking code `01<GTIN 14>21<serial 7><GS>93<check code 4>`"""
+    def chars(alphabet: bytes, count: int) -> bytes:
+        return bytes(alphabet[i] for i in rng.integers(0, len(alphabet), count))
+    return (b'01' + chars(b'0123456789', 14) + b'21' + chars(b'0123456789', 1) + chars(_SERIAL_CHARS, 6) +
+            b'\x1d93' + chars(_SERIAL_CHARS, 4))
+
+
+def encode_symbol(data: bytes):
+    encoded = pylibdmtx.encode(data)
+    pixels = numpy.frombuffer(encoded.pixels, dtype=numpy.uint8)
+    symbol = pixels.reshape(encoded.height, encoded.width, encoded.bpp // 8)
+    return cv2.cvtColor(symbol, cv2.COLOR_RGB2GRAY)
+
+
+def rotate(image, angle: float):
+    """Rotates the image on a white background large enough to hold it"""
+    height, width = image.shape
+    matrix = cv2.getRotationMatrix2D((width / 2, height / 2), angle, 1.0)
+    cos, sin = abs(matrix[0, 0]), abs(matrix[0, 1])
+    size = (int(height * sin + width * cos), int(height * cos + width * sin))
+    matrix[0, 2] += size[0] / 2 - width / 2
+    matrix[1, 2] += size[1] / 2 - height / 2
+    return cv2.warpAffine(image, matrix, size, flags=cv2.INTER_LINEAR, borderValue=255)
+
+
+def render_box(codes: List[bytes], rotation: float, blur: float, noise: float, scale: float,
+               rng: numpy.random.Generator):
+    """Camera frame of a box: codes in a grid of bottle caps on an unevenly lit background"""
+    height, width = FRAME_SIZE
+    # light falls from one side
+    canvas = numpy.tile(numpy.linspace(190, 240, width), (height, 1))
+    cols = math.ceil(math.sqrt(len(codes) * width / height))
+    rows = math.ceil(len(codes) / cols)
+    cell_height, cell_width = height // rows, width // cols
+    for i, data in enumerate(codes):
+        symbol = encode_symbol(data)
+        symbol = cv2.resize(symbol, None, fx=scale, fy=scale,
+                            interpolation=cv2.INTER_AREA if scale < 1 else cv2.INTER_NEAREST)
+        angle = rotation * rng.choice((-1, 1)) + rng.uniform(-3, 3)
+        symbol = rotate(symbol, angle)
+        # large codes are shrunk to fit their cell
+        fit = min(1.0, cell_height / symbol.shape[0], cell_width / symbol.shape[1])
+        if fit < 1.0:
+            symbol = cv2.resize(symbol, None, fx=fit, fy=fit, interpolation=cv2.INTER_AREA)
+        top = (i // cols) * cell_height + int(rng.integers(0, cell_height - symbol.shape[0] + 1))
+        left = (i % cols) * cell_width + int(rng.integers(0, cell_width - symbol.shape[1] + 1))
+        region = canvas[top:top + symbol.shape[0], left:left + symbol.shape[1]]
+        # the quiet zone of the symbol is white, the background shows through it
+        numpy.minimum(region, symbol, out=region)
+    if blur:
+        canvas = cv2.GaussianBlur(canvas, (0, 0), blur)
+    if noise:
+        canvas = canvas + rng.normal(0, noise, canvas.shape)
+    image = numpy.clip(canvas, 0, 255).astype(numpy.uint8)
+    # cameras deliver color JPEGs
+    image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+    ok, buffer = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY])
+    if not ok:
+        raise cv2.error("JPEG encoding failed")
+    return buffer.tobytes()
+
+
+def corpus_params(frames: int, seed: int) -> dict:
+    return {"frames": frames, "seed": seed, "frame_size": list(FRAME_SIZE), "axes": AXES,
+            "jpeg_quality": JPEG_QUALITY}
+
+
+def generate_corpus(path: str, frames: int, seed: int) -> None:
+    os.makedirs(path, exist_ok=True)
+    rng = numpy.random.default_rng(seed)
+    manifest = {"params": corpus_params(frames, seed), "frames": []}
+    for i in range(frames):
+        params = {axis: values[int(rng.integers(0, len(values)))] for axis, values in AXES.items()}
+        codes = [random_km(rng) for _ in range(params['count'])]
+        name = f"frame_{i:04d}.jpg"
+        with open(os.path.join(path, name), 'wb') as file:
+            file.write(render_box(codes, params['rotation'], params['blur'], params['noise'], params['scale'], rng))
+        manifest["frames"].append({"file": name, "codes": [base64.b64encode(code).decode('ascii') for code in codes],
+                                   **params})
+    with open(os.path.join(path, 'manifest.json'), 'w') as file:
+        json.dump(manifest, file, indent=1)
+
+
+def load_corpus(path: str, frames: int, seed: int) -> List[Frame]:
+    """Reads the recorded corpus, generating it first if it is missing or was generated with other parameters"""
+    manifest_path = os.path.join(path, 'manifest.json')
+    manifest = None
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as file:
+            manifest = json.load(file)
+    # JSON turns the tuples of the axes into lists
+    if manifest is None or manifest["params"] != json.loads(json.dumps(corpus_params(frames, seed))):
+        print(f"Генерирую корпус из {frames} кадров в {path}...")
+        generate_corpus(path, frames, seed)
+        with open(manifest_path) as file:
+            manifest = json.load(file)
+    corpus = []
+    for entry in manifest["frames"]:
+        with open(os.path.join(path, entry["file"]), 'rb') as file:
+            jpeg = file.read()
+        codes = frozenset(base64.b64decode(code) for code in entry["codes"])
+        params = {axis: entry[axis] for axis in AXES}
+        corpus.append(Frame(entry["file"], jpeg, codes, params))
+    return corpus
+
+
+def _decode(image, count, args):
+    return [decoded.data for decoded in pylibdmtx.decode(image, timeout=args.timeout * 1000, max_count=count)]
+
+
+def _decode_with_regions(image, count, args):
+    return [msg.decoded.data for msg in pylibdmtx.decode_with_regions(image, timeout=args.timeout * 1000,
+                                                                      max_count=count)]
+
+
+def _decode_frame(tile_workers: int = 0):
+    def decode(image, count, args, preprocessor):
+        found, _ = decode_frame(image, timeout=args.timeout * 1000, max_count=count, max_edge=args.max_edge,
+                                tile_workers=tile_workers, preprocessor=preprocessor)
+        return [msg.decoded.data for msg in found]
+    return decode
+
+
+def create_configs() -> Dict[str, DecoderConfig]:
+    def with_preprocessor(decode, preprocessor):
+        return DecoderConfig(preprocessor, lambda image, count, args: decode(image, count, args, preprocessor))
+
+    unchanged = FramePreprocessor()
+    return {
+        'decode': DecoderConfig(unchanged, _decode),
+        'decode_with_regions': DecoderConfig(unchanged, _decode_with_regions),
+        # as the pipeline decodes a frame without regions of interest from the previous frames
+        'decode_frame': with_preprocessor(_decode_frame(), unchanged),
+        'decode_frame_gray': with_preprocessor(_decode_frame(), FramePreprocessor(imread_mode='gray')),
+        'decode_frame_reduced2': with_preprocessor(_decode_frame(), FramePreprocessor(imread_mode='reduced2')),
+        'decode_frame_tiled': with_preprocessor(_decode_frame(tile_workers=os.cpu_count() or 1), unchanged),
+    }
+
+
+def percentile(values: List[float], q: float) -> float:
+    """Nearest-rank percentile"""
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(q / 100 * len(ordered)) - 1)]
+
+
+def run_config(config: DecoderConfig, corpus: List[Frame], args) -> dict:
+    for frame in corpus[:args.warmup]:
+        config.decode(config.preprocessor.decode_jpeg(frame.jpeg), len(frame.codes), args)
+    latencies = []
+    found_count = expected_count = false_count = 0
+    cpu_started, wall_started = time.process_time(), time.perf_counter()
+    for _ in range(args.repeat):
+        for frame in corpus:
+            started = time.perf_counter()
+            image = config.preprocessor.decode_jpeg(frame.jpeg)
+            found = set(config.decode(image, len(frame.codes), args))
+            latencies.append(time.perf_counter() - started)
+            found_count += len(found & frame.codes)
+            false_count += len(found - frame.codes)
+            expected_count += len(frame.codes)
+    wall = time.perf_counter() - wall_started
+    cpu = time.process_time() - cpu_started
+    return {
+        "frames": len(latencies),
+        "fps": len(latencies) / wall,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "recall": found_count / expected_count if expected_count else 1.0,
+        "false_positives": false_count,
+        "cpu_ms_per_frame": cpu / len(latencies) * 1000,
+        # more than 1 when the decoder runs on several cores
+        "cpu_utilization": cpu / wall,
+    }
+
+
+def print_results(results: Dict[str, dict]) -> None:
+    print(f"{'конфигурация':<24}{'кадр/с':>9}{'p50, мс':>10}{'p95, мс':>10}{'полнота':>9}{'ложных':>8}"
+          f"{'CPU мс/кадр':>13}{'CPU':>7}")
+    for name, result in results.items():
+        print(f"{name:<24}{result['fps']:>9.2f}{result['p50_ms']:>10.1f}{result['p95_ms']:>10.1f}"
+              f"{result['recall']:>9.3f}{result['false_positives']:>8d}{result['cpu_ms_per_frame']:>13.1f}"
+              f"{result['cpu_utilization']:>7.2f}")
+
+
+def compare(results: Dict[str, dict], baseline: dict, tolerance: float, recall_tolerance: float) -> List[str]:
+    """Returns the regressions against the baseline"""
+    regressions = []
+    for name, result in results.items():
+        base = baseline["results"].get(name)
+        if base is None:
+            continue
+        if result["fps"] < base["fps"] * (1 - tolerance):
+            regressions.append(f"{name}: кадр/с {result['fps']:.2f} < {base['fps']:.2f}")
+        if result["p95_ms"] > base["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{name}: p95 {result['p95_ms']:.1f} мс > {base['p95_ms']:.1f} мс")
+        if result["cpu_ms_per_frame"] > base["cpu_ms_per_frame"] * (1 + tolerance):
+            regressions.append(f"{name}: CPU {result['cpu_ms_per_frame']:.1f} мс/кадр > "
+                               f"{base['cpu_ms_per_frame']:.1f} мс/кадр")
+        if result["recall"] < base["recall"] - recall_tolerance:
+            regressions.append(f"{name}: полнота {result['recall']:.3f} < {base['recall']:.3f}")
+    return regressions
+
+
+def machine() -> dict:
+    return {"node": platform.node(), "processor": platform.processor() or platform.machine(),
+            "cpu_count": os.cpu_count(), "python": platform.python_version(), "libdmtx": dmtxVersion()}
+
+
+def parse_args(configs: Dict[str, DecoderConfig]):
+    benchmarks_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description='Бенчмарк распознавания DataMatrix на синтетических кадрах коробок')
+    parser.add_argument('--corpus', type=str, default=os.path.join(benchmarks_dir, 'corpus'),
+                        help='Директория корпуса кадров, создаётся при отсутствии')
+    parser.add_argument('--frames', type=int, default=60, help='Количество кадров в корпусе')
+    parser.add_argument('--seed', type=int, default=1, help='Зерно генератора корпуса')
+    parser.add_argument('--configs', nargs='+', choices=list(configs), default=list(configs),
+                        help='Конфигурации декодера')
+    parser.add_argument('--timeout', type=int, default=2, help='Таймаут для декодирования DataMatrix, с')
+    parser.add_argument('--max_edge', type=int, default=200, help='Максимальная сторона кода, пикселей кадра')
+    parser.add_argument('--warmup', type=int, default=2, help='Кадров для прогрева перед измерением')
+    parser.add_argument('--repeat', type=int, default=1, help='Сколько раз прогнать корпус')
+    parser.add_argument('--baseline', type=str, default=os.path.join(benchmarks_dir, 'baseline.json'),
+                        help='Файл базовых результатов для сравнения')
+    parser.add_argument('--save_baseline', action='store_true', help='Сохранить результаты как базовые')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='Допустимое ухудшение кадр/с, p95 и CPU относительно базовых, доля')
+    parser.add_argument('--recall_tolerance', type=float, default=0.005,
+                        help='Допустимое снижение полноты относительно базовой')
+    parser.add_argument('--output', type=str, default=None, help='JSON файл для результатов')
+    return parser.parse_args()
+
+
+def main():
+    configs = create_configs()
+    args = parse_args(configs)
+    corpus = load_corpus(args.corpus, args.frames, args.seed)
+    print(f"Корпус: {len(corpus)} кадров, {sum(len(frame.codes) for frame in corpus)} кодов")
+    results = {}
+    for name in args.configs:
+        print(f"Измеряю {name}...")
+        results[name] = run_config(configs[name], corpus, args)
+    print_results(results)
+    report = {"corpus": corpus_params(args.frames, args.seed), "machine": machine(),
+              "args": {"timeout": args.timeout, "max_edge": args.max_edge}, "results": results}
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=1)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as file:
+            json.dump(report, file, indent=1)
+        print(f"Базовые результаты сохранены в {args.baseline}")
+        return 0
+    if not os.path.exists(args.baseline):
+        print(f"Базовых результатов {args.baseline} нет, сравнение пропущено")
+        return 0
+    with open(args.baseline) as file:
+        baseline = json.load(file)
+    if baseline["corpus"] != json.loads(json.dumps(report["corpus"])) or baseline["args"] != report["args"]:
+        print("Базовые результаты получены на другом корпусе или с другими параметрами, сравнение пропущено")
+        return 0
+    if baseline["machine"] != report["machine"]:
+        print(f"Внимание: базовые результаты получены на другой машине: {baseline['machine']}")
+    regressions = compare(results, baseline, args.tolerance, args.recall_tolerance)
+    for regression in regressions:
+        print(f"Регрессия: {regression}")
+    if not regressions:
+        print("Регрессий относительно базовых результатов нет")
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,147 @@
+"""Stand-in for a camera MJPEG stream, for running the decoder locally and in tests without a camera.
+
+    python -m tests.mjpeg_stub_server --port 8090 --fps 10 snapshot1.jpg snapshot2.jpg
+
+serves the given JPEG files in a loop as multipart/x-mixed-replace on http://localhost:8090/ and the latest one
+as a single snapshot on http://localhost:8090/snapshot.jpg. With `--user` and `--password` both ask for HTTP Digest
+authentication, the way the cameras do.
+"""
+import argparse
+import hashlib
+import itertools
+import re
+import secrets
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Tuple
+
+BOUNDARY = 'frame'
+REALM = 'mjpeg_stub_server'
+
+
+def _md5(*parts: str) -> str:
+    return hashlib.md5(':'.join(parts).encode()).hexdigest()
+
+
+class MjpegStubServer:
+    def __init__(self, frames: List[bytes], host: str = '127.0.0.1', port: int = 0, fps: float = 10.0,
+                 credentials: Tuple[str, str] | None = None):
+        if not frames:
+            raise ValueError('At least one JPEG frame is required')
+        self.frames = frames
+        self.fps = fps
+        # user name and password of the Digest authentication, None to serve everybody
+        self.credentials = credentials
+        self.nonce = secrets.token_hex(16)
+        # requests turned down for missing or wrong credentials
+        self.unauthorized = 0
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._thread: threading.Thread | None = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def authorized(self, method: str, authorization: str | None) -> bool:
+        """Checks a Digest `Authorization` header (RFC 7616, MD5 with qop=auth)"""
+        if self.credentials is None:
+            return True
+        if not authorization or not authorization.startswith('Digest '):
+            return False
+        fields = {key: quoted or plain
+                  for key, quoted, plain in re.findall(r'(\w+)=(?:"([^"]*)"|([^,\s]*))', authorization)}
+        username, password = self.credentials
+        if fields.get('username') != username or fields.get('nonce') != self.nonce:
+            return False
+        ha1 = _md5(username, REALM, password)
+        ha2 = _md5(method, fields.get('uri', ''))
+        if fields.get('qop') == 'auth':
+            expected = _md5(ha1, self.nonce, fields.get('nc', ''), fields.get('cnonce', ''), 'auth', ha2)
+        else:
+            expected = _md5(ha1, self.nonce, ha2)
+        return fields.get('response') == expected
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if not stub.authorized('GET', self.headers.get('Authorization')):
+                    self._send_unauthorized()
+                elif self.path.startswith('/snapshot'):
+                    self._send_snapshot()
+                else:
+                    self._send_stream()
+
+            def _send_unauthorized(self):
+                stub.unauthorized += 1
+                self.send_response(401)
+                self.send_header('WWW-Authenticate',
+                                 f'Digest realm="{REALM}", nonce="{stub.nonce}", qop="auth", algorithm=MD5')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def _send_snapshot(self):
+                frame = stub.frames[int(time.time() * stub.fps) % len(stub.frames)]
+                self.send_response(200)
+                self.send_header('Content-Type', 'image/jpeg')
+                self.send_header('Content-Length', str(len(frame)))
+                self.end_headers()
+                self.wfile.write(frame)
+
+            def _send_stream(self):
+                self.send_response(200)
+                self.send_header('Content-Type', f'multipart/x-mixed-replace; boundary={BOUNDARY}')
+                self.end_headers()
+                try:
+                    for frame in itertools.cycle(stub.frames):
+                        self.wfile.write(f'--{BOUNDARY}\r\nContent-Type: image/jpeg\r\n'
+                                         f'Content-Length: {len(frame)}\r\n\r\n'.encode('ascii'))
+                        self.wfile.write(frame)
+                        self.wfile.write(b'\r\n')
+                        time.sleep(1 / stub.fps)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self) -> 'MjpegStubServer':
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True, name='mjpeg_stub_server')
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Тестовый MJPEG поток из JPEG файлов')
+    parser.add_argument('frames', nargs='*', default=['no_image_available.jpg'], help='JPEG файлы кадров')
+    parser.add_argument('--host', type=str, default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--fps', type=float, default=10.0)
+    parser.add_argument('--user', type=str, default=None, help='Пользователь для Digest авторизации')
+    parser.add_argument('--password', type=str, default=None, help='Пароль для Digest авторизации')
+    args = parser.parse_args()
+    frames = []
+    for path in args.frames:
+        with open(path, 'rb') as file:
+            frames.append(file.read())
+    credentials = (args.user, args.password) if args.user is not None else None
+    server = MjpegStubServer(frames, host=args.host, port=args.port, fps=args.fps, credentials=credentials)
+    print(f"MJPEG поток: {server.url}, снимок: {server.url}snapshot.jpg")
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
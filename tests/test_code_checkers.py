@@ -0,0 +1,86 @@
+import base64
+import re
+
+import pytest
+
+from backend.src.MarkingCode import MarkingCode
+from backend.src.code_checkers import is_ka_valid, is_km_valid, ka_fields, km_fields, parse_ka, parse_km
+
+# the regular expressions the codes were validated with before the one pass parsers
+KM_PATTERN = re.compile(r'^01\d{14}21\d{1}[A-Za-z0-9!@#$%^&*()_+={}\[\]:;"\'<>,.?/\\|`~\-]{6}\x1d93'
+                        r'[A-Za-z0-9!@#$%^&*()_+={}\[\]:;"\'<>,.?/\\|`~\-]{4}$')
+KA_PATTERN = re.compile(r'^02\d{14}\x1d37\d{2}\x1d21[A-Za-z0-9!@#$%^&*()_+={}\[\]:;"\'<>,.?/\\|`~\-]+$')
+
+KMS = [base64.b64decode(code) for code in (
+    "MDEwNDY4MDU3MTA2MTIyNjIxNVlGWC8wbh05M1VlVSs=",
+    "MDEwNDY4MDU3MTA2MTIyNjIxNUVpZzUmbx05M3cxbS8=",
+    "MDEwNDY4MDU3MTA2MTIyNjIxNT5QaFZzKB05MzlMRng=",
+    "MDEwNDY4MDU3MTA2MTIyNjIxNUpDVCxyTR05M3IremU=",
+    "MDEwNDY4MDU3MTA2MTIyNjIxNS9LO2hZMB05M2VQd0g=",
+)]
+KAS = [base64.b64decode("MDIwNDY4MDU3MTA2MTIyNh0zNzEyHTIxQUEwMzM="),
+       b'0204680571061226\x1d3712\x1d21A',
+       b'0204680571061226\x1d3799\x1d21' + b'x' * 40]
+# replacements tried at every position: digits, letters, punctuation, separators, non-ASCII
+REPLACEMENTS = [b'0', b'7', b'a', b'Z', b'-', b'~', b'\\', b' ', b'\x1d', b'\x00', b'\xc3\xa9', b'\xff']
+
+
+def old_verdict(pattern: re.Pattern, data: bytes) -> bool:
+    try:
+        return bool(pattern.match(data.decode('utf-8')))
+    except UnicodeDecodeError:
+        return False
+
+
+def mutations(code: bytes):
+    yield code
+    for position in range(len(code) + 1):
+        yield code[:position]
+        yield code[:position] + code[position + 1:]
+        for replacement in REPLACEMENTS:
+            yield code[:position] + replacement + code[position + 1:]
+            yield code[:position] + replacement + code[position:]
+
+
+@pytest.mark.parametrize('code', KMS)
+def test_parse_km_agrees_with_the_old_pattern(code):
+    for data in mutations(code):
+        assert (parse_km(data) is not None) == old_verdict(KM_PATTERN, data), data
+
+
+@pytest.mark.parametrize('code', KAS)
+def test_parse_ka_agrees_with_the_old_pattern(code):
+    for data in mutations(code):
+        assert (parse_ka(data) is not None) == old_verdict(KA_PATTERN, data), data
+
+
+def test_codes_are_not_mistaken_for_each_other():
+    assert all(parse_ka(code) is None for code in KMS)
+    assert all(parse_km(code) is None for code in KAS)
+
+
+def test_ka_with_a_single_character_serial_is_valid():
+    data = b'0204680571061226\x1d3712\x1d21A'
+    assert len(data) == 25
+    assert parse_ka(data).serial == 'A'
+    assert parse_ka(data[:-1]) is None
+
+
+def test_fields():
+    km = km_fields(MarkingCode(KMS[0]))
+    assert (km.gtin, km.serial, km.check_code, km.count) == ('04680571061226', '5YFX/0n', 'UeU+', None)
+    ka = ka_fields(base64.b64encode(KAS[0]).decode())
+    assert (ka.gtin, ka.serial, ka.count, ka.check_code) == ('04680571061226', 'AA033', 12, None)
+
+
+def test_validators_accept_every_representation_of_a_code():
+    for code in (KMS[0], MarkingCode(KMS[0]), base64.b64encode(KMS[0]).decode()):
+        assert is_km_valid(code) and not is_ka_valid(code)
+    assert not is_km_valid('not base64!') and not is_ka_valid('not base64!')
+
+
+@pytest.mark.parametrize('data', [KMS[0] + b'\n', KMS[0][:2] + '٠'.encode() + KMS[0][3:]])
+def test_stricter_than_the_old_pattern(data):
+    # `$` let a trailing newline through and `\d` matched any Unicode digit, neither occurs in a printed code
+    assert old_verdict(KM_PATTERN, data)
+    assert parse_km(data) is None
@@ -0,0 +1,42 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+# the decoder calls libdmtx
+pytest.importorskip('backend.src.pylibdmtx.pylibdmtx', reason='libdmtx is not installed', exc_type=ImportError)
+
+from backend.src.DataMatrixDecoder import DataMatrixDecoder  # noqa: E402
+from backend.src.DecodeExecutor import create_decode_executor  # noqa: E402
+from backend.src.FrameSource import FrameSource  # noqa: E402
+
+
+async def no_codes(codes):
+    pass
+
+
+def test_failed_hand_over_releases_the_decode_slot():
+    failures = []
+
+    def broken_request():
+        failures.append(None)
+        raise RuntimeError('the state is being reset')
+
+    async def main():
+        decoder = DataMatrixDecoder('stub', max_count=4, timeout=100, callback=no_codes,
+                                    decode_executor=create_decode_executor('inline'), max_in_flight=2,
+                                    decode_request=broken_request, frame_source=FrameSource('stub'), line='test')
+        consumer = asyncio.create_task(decoder.image_consumer())
+        try:
+            for _ in range(5):
+                await decoder.frame_buffer.put((np.zeros((10, 10), np.uint8), 0.0))
+                await asyncio.sleep(0.15)
+            assert len(failures) == 5
+            # more failures than slots, yet the next frame still gets decoded
+            decoder.decode_request = lambda: (None, frozenset(), None)
+            await decoder.frame_buffer.put((np.zeros((10, 10), np.uint8), 0.0))
+            await asyncio.wait_for(decoder.decoded_queue.get(), 1)
+        finally:
+            consumer.cancel()
+
+    asyncio.run(main())
@@ -0,0 +1,81 @@
+import threading
+
+import pytest
+
+from backend.src import DatabaseManager as database_manager
+from backend.src.CodeIndex import CodeIndex
+from backend.src.DatabaseManager import DatabaseManager
+from backend.src.MarkingCode import MarkingCode
+
+
+def wait_for_indexes(db: DatabaseManager, timeout: float = 10.0) -> None:
+    for thread in threading.enumerate():
+        if thread.name.startswith('index_'):
+            thread.join(timeout)
+    assert not db._index_backlog
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    # the database lives in results/database of the working directory
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+def codes(prefix: str, count: int):
+    return [MarkingCode(f"{prefix}{i:04d}".encode()) for i in range(count)]
+
+
+def test_lookups_are_answered_before_and_after_the_index_is_built(workdir):
+    saved = codes('km', 8)
+    db = DatabaseManager()
+    wait_for_indexes(db)
+    db.save_codes(saved, MarkingCode(b'ka0001'))
+    db.close()
+
+    db = DatabaseManager()
+    try:
+        assert db.existing_individual_codes(saved + codes('new', 3)) == set(saved)
+        wait_for_indexes(db)
+        assert set(db._indexes) == {'individual_codes', 'group_codes'}
+        assert db.existing_individual_codes(saved + codes('new', 3)) == set(saved)
+        assert db.is_group_code_exists(MarkingCode(b'ka0001'))
+    finally:
+        db.close()
+
+
+def test_codes_saved_while_the_index_is_built_get_into_it(workdir, monkeypatch):
+    started, release = threading.Event(), threading.Event()
+
+    class SlowCodeIndex(CodeIndex):
+        def __init__(self, *args, **kwargs):
+            started.set()
+            release.wait(10)
+            super().__init__(*args, **kwargs)
+
+    monkeypatch.setattr(database_manager, 'CodeIndex', SlowCodeIndex)
+    db = DatabaseManager()
+    try:
+        assert started.wait(10)
+        saved = codes('km', 4)
+        assert db.save_codes(saved, MarkingCode(b'ka0001')) == 1
+        release.set()
+        wait_for_indexes(db)
+        index = db._indexes['individual_codes']
+        assert all(code in index.bloom for code in saved)
+        assert db.existing_individual_codes(saved) == set(saved)
+    finally:
+        release.set()
+        db.close()
+
+
+def test_index_is_sized_for_the_growth_of_the_last_year(workdir):
+    db = DatabaseManager()
+    try:
+        wait_for_indexes(db)
+        db.save_codes(codes('km', 10), MarkingCode(b'ka0001'))
+        db._load_index('individual_codes', min_capacity=1)
+        # ten codes, all of them saved within the last year
+        assert db._indexes['individual_codes'].bloom.capacity == 30
+    finally:
+        db.close()
@@ -0,0 +1,78 @@
+import numpy as np
+import pytest
+
+# the decode job calls libdmtx
+pytest.importorskip('backend.src.pylibdmtx.pylibdmtx', reason='libdmtx is not installed', exc_type=ImportError)
+
+from backend.src import DataMatrixDecoder as data_matrix_decoder  # noqa: E402
+from backend.src.DataMatrixDecoder import decode_frame  # noqa: E402
+from backend.src.code_checkers import parse_ka, parse_km  # noqa: E402
+from backend.src.pylibdmtx import pylibdmtx  # noqa: E402
+
+KA = b'0204680571061226\x1d3712\x1d21AA033'
+
+
+def km(serial: int) -> bytes:
+    return b'010468057106122621' + f"{serial:07d}".encode() + b'\x1d93UeU+'
+
+
+def region(data: bytes, x: int = 0):
+    corners = ((x, 0), (x + 10, 0), (x + 10, 10), (x, 10))
+    return pylibdmtx.DecodedRegion(pylibdmtx.Decoded(data, pylibdmtx.Rect(x, 10, 10, 10)), corners, 0, 10, 0)
+
+
+class FakeLibdmtx:
+    """Finds the given codes in the regions of interest and on the full frame scan, in order"""
+
+    def __init__(self, monkeypatch, in_rois=(), on_scan=()):
+        self.in_rois = [region(data, 20 * i) for i, data in enumerate(in_rois)]
+        self.on_scan = [region(data, 20 * i) for i, data in enumerate(on_scan)]
+        self.scanned = 0
+        self.scan_max_count = None
+        monkeypatch.setattr(data_matrix_decoder.pylibdmtx, 'decode_with_regions_in_rois', self.decode_rois)
+        monkeypatch.setattr(data_matrix_decoder.pylibdmtx, 'iter_decode_with_regions', self.iter_decode)
+
+    def decode_rois(self, image, rois, max_count=None, **kwargs):
+        return self.in_rois[:max_count]
+
+    def iter_decode(self, image, max_count=None, **kwargs):
+        self.scan_max_count = max_count
+        for msg in self.on_scan[:max_count]:
+            self.scanned += 1
+            yield msg
+
+
+def decode(**kwargs):
+    image = np.zeros((100, 200), np.uint8)
+    found, _ = decode_frame(image, timeout=1000, max_edge=50, **kwargs)
+    return [msg.decoded.data for msg in found]
+
+
+def test_scan_stops_once_needed_new_codes_are_found(monkeypatch):
+    known = {km(1), km(2)}
+    fake = FakeLibdmtx(monkeypatch, on_scan=[km(1), km(3), km(2), km(4), km(5), km(6)])
+    found = decode(max_count=12, needed=2, known=known, counts=parse_km)
+    # two new codes complete the box, the rest of the frame is not scanned
+    assert found == [km(1), km(3), km(2), km(4)]
+    assert fake.scanned == 4
+
+
+def test_codes_of_another_kind_do_not_count_towards_needed(monkeypatch):
+    fake = FakeLibdmtx(monkeypatch, on_scan=[KA, km(1)])
+    assert decode(max_count=12, needed=1, counts=parse_km) == [KA, km(1)]
+    assert fake.scanned == 2
+
+
+def test_tracked_codes_of_another_kind_do_not_skip_the_scan(monkeypatch):
+    bottles = [km(i) for i in range(1, 4)]
+    fake = FakeLibdmtx(monkeypatch, in_rois=bottles, on_scan=[KA])
+    # the bottle codes alone fill max_count, the aggregation code is only found by the full frame scan
+    found = decode(max_count=3, rois=[(0, 0, 10, 10)] * 3, counts=parse_ka)
+    assert found == bottles + [KA]
+    assert fake.scan_max_count == 3
+
+
+def test_scan_is_skipped_when_regions_of_interest_have_everything(monkeypatch):
+    fake = FakeLibdmtx(monkeypatch, in_rois=[km(1), km(2)], on_scan=[km(3)])
+    assert decode(max_count=2, rois=[(0, 0, 10, 10)] * 2, counts=parse_km) == [km(1), km(2)]
+    assert fake.scan_max_count is None
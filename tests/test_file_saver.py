@@ -0,0 +1,29 @@
+import asyncio
+import json
+import os
+
+from backend.src.FileSaver import FileSaver
+
+
+def test_boxes_are_written_and_leave_the_journal(tmp_path):
+    saver = FileSaver(str(tmp_path))
+
+    async def main():
+        for name in ('0001_01012025', '0002_01012025'):
+            assert await saver.save_aggregation(name, ['a2l0', 'a2wy'], 'Z3JvdXA=') == 0
+
+    asyncio.run(main())
+    saver.close()
+    assert sorted(os.listdir(tmp_path / 'xml')) == ['0001_01012025.xml', '0002_01012025.xml']
+    assert sorted(os.listdir(tmp_path / 'csv')) == ['0001_01012025.csv', '0002_01012025.csv']
+    assert saver.get_stats()['pending'] == 0
+    assert (tmp_path / 'journal.jsonl').read_text() == ''
+
+
+def test_journaled_boxes_are_written_on_the_next_start(tmp_path):
+    job = {"filename": "0003_01012025", "codes": ['a2l0'], "group_code": 'Z3JvdXA='}
+    (tmp_path / 'journal.jsonl').write_text(json.dumps({"op": "save", **job}) + "\n")
+    saver = FileSaver(str(tmp_path))
+    saver.close()
+    assert os.listdir(tmp_path / 'xml') == ['0003_01012025.xml']
+    assert (tmp_path / 'journal.jsonl').read_text() == ''
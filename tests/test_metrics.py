@@ -0,0 +1,53 @@
+import pytest
+
+from backend.src.metrics import Counter, Gauge, Histogram, MetricsRegistry
+
+
+def test_render():
+    registry = MetricsRegistry()
+    frames = Counter('frames_total', 'Frames', ('line',), registry=registry)
+    depth = Gauge('depth', 'Depth', ('line',), registry=registry)
+    seconds = Histogram('seconds', 'Seconds', buckets=(0.1, 1), registry=registry)
+    frames.inc(line='a')
+    frames.inc(2, line='a')
+    depth.set(4, line='a"b')
+    seconds.observe(0.5)
+    assert registry.render().splitlines() == [
+        '# HELP frames_total Frames',
+        '# TYPE frames_total counter',
+        'frames_total{line="a"} 3',
+        '# HELP depth Depth',
+        '# TYPE depth gauge',
+        'depth{line="a\\"b"} 4',
+        '# HELP seconds Seconds',
+        '# TYPE seconds histogram',
+        'seconds_bucket{le="0.1"} 0',
+        'seconds_bucket{le="1"} 1',
+        'seconds_bucket{le="+Inf"} 1',
+        'seconds_sum 0.5',
+        'seconds_count 1',
+    ]
+
+
+def test_values_read_from_functions():
+    registry = MetricsRegistry()
+    dropped = Counter('dropped_total', 'Dropped', ('line',), registry=registry)
+    fps = Gauge('fps', 'Frames per second', ('line',), registry=registry)
+    total = [0]
+    dropped.set_function(lambda: total[0], line='a')
+    fps.set_function(lambda: None, line='a')
+    total[0] = 7
+    assert 'dropped_total{line="a"} 7' in registry.render().splitlines()
+    # nothing to report yet
+    assert not fps.samples()
+    with pytest.raises(ValueError):
+        dropped.inc(line='a')
+
+
+def test_labels_and_names_are_checked():
+    registry = MetricsRegistry()
+    counter = Counter('total', 'Total', ('line',), registry=registry)
+    with pytest.raises(ValueError):
+        counter.inc()
+    with pytest.raises(ValueError):
+        Gauge('total', 'Total', registry=registry)
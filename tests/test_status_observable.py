@@ -0,0 +1,49 @@
+import asyncio
+import threading
+
+import pytest
+
+from backend.src.StatusObservable import StatusObservable
+
+
+class Observer:
+    def __init__(self):
+        self.updates = []
+
+    def update_devices(self, status):
+        self.updates.append((status, threading.current_thread()))
+
+
+def test_statuses_set_from_other_threads_are_delivered_on_the_loop():
+    observable = StatusObservable()
+    observer = Observer()
+
+    async def main():
+        observable.subscribe(observer)
+        writer = threading.Thread(target=lambda: [setattr(observable, 'status', i) for i in range(5)])
+        writer.start()
+        writer.join()
+        await asyncio.sleep(0.01)
+
+    asyncio.run(main())
+    # changes made before the loop gets to them are coalesced
+    assert observer.updates == [(4, threading.main_thread())]
+
+
+def test_unchanged_status_is_not_published_again():
+    observable = StatusObservable()
+    observer = Observer()
+
+    async def main():
+        observable.subscribe(observer)
+        for status in ('a', 'a', 'b'):
+            observable.status = status
+            await asyncio.sleep(0)
+
+    asyncio.run(main())
+    assert [status for status, _ in observer.updates] == ['a', 'b']
+
+
+def test_subscribe_needs_an_event_loop():
+    with pytest.raises(RuntimeError):
+        StatusObservable().subscribe(Observer())